@@ -0,0 +1,170 @@
+"""
+Acceptance index for the termsandconditions module.
+
+For each terms version, the pks of the users who accepted it are kept as bitmaps in a cache, one per segment of
+SEGMENT_BITS users, so finding that a user accepted the active terms takes bit tests instead of a query. The cache is
+chosen with TERMS_ACCEPTANCE_INDEX, the name of an entry of CACHES; a file based cache keeps the index on local disk.
+
+Cache backends cannot update a bitmap atomically, so bits set concurrently can be lost. The index is therefore only
+trusted to say that a user accepted some terms: clear bits, and missing bitmaps, leave the answer to the database.
+
+Withdrawing an acceptance cannot clear its bit either, as a writer that read the bitmap before could put it back. Each
+segment's bitmap is instead keyed by an epoch, which withdrawals move on: writers still holding the previous epoch then
+write to a key nobody reads any more.
+"""
+
+import time
+from numbers import Integral
+
+from django.conf import settings
+from django.core.cache import caches
+
+SEGMENT_BITS = 2 ** 16
+
+
+def get_index_cache():
+    """Returns the cache holding the acceptance index, or None if the index is not used"""
+    alias = getattr(settings, 'TERMS_ACCEPTANCE_INDEX', None)
+    return caches[alias] if alias else None
+
+
+def _get_timeout():
+    """Returns how long bitmaps are kept"""
+    return getattr(settings, 'TERMS_ACCEPTANCE_INDEX_SECONDS', 86400)
+
+
+def _new_epoch():
+    """Seeds an epoch from the clock, so an epoch lost to eviction never brings back bitmaps of an old one"""
+    return int(time.time() * 1000)
+
+
+def epoch_key(terms_id, segment):
+    """Returns the cache key of the epoch of one segment of users for terms_id"""
+    return 'tandc.acceptance_epoch_{0}_{1}'.format(terms_id, segment)
+
+
+def bitmap_key(terms_id, segment, epoch):
+    """Returns the cache key of the bitmap of one segment of users for terms_id in the given epoch"""
+    return 'tandc.acceptance_bitmap_{0}_{1}_{2}'.format(terms_id, segment, epoch)
+
+
+def _get_epochs(index, terms_ids, segments, start=False):
+    """
+    Returns the epochs of the given segments of terms_ids, as a dict keyed by (terms_id, segment).
+
+    Segments without an epoch are left out, unless start is True, in which case one is started for them.
+    """
+    keys = dict(((terms_id, segment), epoch_key(terms_id, segment)) for terms_id in terms_ids for segment in segments)
+    found = index.get_many(list(keys.values()))
+    epochs = {}
+    for pair, key in keys.items():
+        epoch = found.get(key)
+        if epoch is None and start:
+            epoch = _new_epoch()
+            if not index.add(key, epoch, None):
+                # Another process started the epoch first, use theirs
+                epoch = index.get(key, epoch)
+        if epoch is not None:
+            epochs[pair] = epoch
+    return epochs
+
+
+def _locate(user_pk):
+    """Returns the segment and bit of a user pk, or None if the pk cannot be indexed"""
+    if not isinstance(user_pk, Integral) or isinstance(user_pk, bool) or user_pk < 0:
+        return None
+    return divmod(user_pk, SEGMENT_BITS)
+
+
+def _is_set(bitmap, bit):
+    """Returns True if bit is set in bitmap"""
+    return bool(bytearray(bitmap)[bit >> 3] & (1 << (bit & 7)))
+
+
+def get_unconfirmed_terms_ids(user_pk, terms_ids):
+    """Returns the terms_ids, in order, which the index does not show user_pk to have accepted"""
+    index = get_index_cache()
+    location = _locate(user_pk)
+    if index is None or location is None or not terms_ids:
+        return list(terms_ids)
+
+    segment, bit = location
+    epochs = _get_epochs(index, terms_ids, [segment])
+    keys = dict((terms_id, bitmap_key(terms_id, segment, epochs[(terms_id, segment)]))
+                for terms_id in terms_ids if (terms_id, segment) in epochs)
+    bitmaps = index.get_many(list(keys.values())) if keys else {}
+    return [terms_id for terms_id in terms_ids
+            if terms_id not in keys or keys[terms_id] not in bitmaps or not _is_set(bitmaps[keys[terms_id]], bit)]
+
+
+def mark_accepted(user_pk, terms_ids):
+    """Sets the bits of user_pk for terms_ids, starting empty bitmaps where there are none"""
+    index = get_index_cache()
+    location = _locate(user_pk)
+    if index is None or location is None or not terms_ids:
+        return
+
+    segment, bit = location
+    epochs = _get_epochs(index, terms_ids, [segment], start=True)
+    keys = [bitmap_key(terms_id, segment, epochs[(terms_id, segment)]) for terms_id in terms_ids]
+    bitmaps = index.get_many(keys)
+    updated = {}
+    for key in keys:
+        bitmap = bytearray(bitmaps.get(key) or bytearray(SEGMENT_BITS // 8))
+        bitmap[bit >> 3] |= 1 << (bit & 7)
+        updated[key] = bytes(bitmap)
+    index.set_many(updated, _get_timeout())
+
+
+def forget_accepted(user_pk, terms_ids):
+    """Moves the segment holding user_pk on to a new, empty epoch for terms_ids, as a bit cannot be cleared safely"""
+    index = get_index_cache()
+    location = _locate(user_pk)
+    if index is None or location is None or not terms_ids:
+        return
+
+    segment = location[0]
+    epochs = _get_epochs(index, terms_ids, [segment])
+    for terms_id in terms_ids:
+        try:
+            index.incr(epoch_key(terms_id, segment))
+        except ValueError:
+            index.set(epoch_key(terms_id, segment), _new_epoch(), None)
+    # The bitmaps of the previous epochs are never read again
+    index.delete_many([bitmap_key(terms_id, segment, epoch) for (terms_id, segment), epoch in epochs.items()])
+
+
+def build(terms_id, user_pks, max_user_pk):
+    """
+    Replaces the bitmaps of terms_id with ones holding user_pks, returns the number of users indexed.
+
+    The epochs of the segments up to max_user_pk are read before user_pks is iterated, so user_pks should be a lazy
+    query: a withdrawal committed while it runs moves its segment to a new epoch, and the bitmap built from rows read
+    before it is written to the previous one. Users past max_user_pk are left to the signals.
+    """
+    index = get_index_cache()
+    location = _locate(max_user_pk)
+    if index is None or location is None:
+        return 0
+
+    segments = range(location[0] + 1)
+    epochs = _get_epochs(index, [terms_id], segments, start=True)
+    bitmaps = {}
+    indexed = 0
+    for user_pk in user_pks:
+        location = _locate(user_pk)
+        if location is None or (terms_id, location[0]) not in epochs:
+            continue
+        segment, bit = location
+        bitmap = bitmaps.get(segment)
+        if bitmap is None:
+            bitmap = bitmaps[segment] = bytearray(SEGMENT_BITS // 8)
+        bitmap[bit >> 3] |= 1 << (bit & 7)
+        indexed += 1
+
+    index.set_many(dict((bitmap_key(terms_id, segment, epochs[(terms_id, segment)]), bytes(bitmap))
+                        for segment, bitmap in bitmaps.items()), _get_timeout())
+    # Segments nobody accepted any more
+    index.delete_many([bitmap_key(terms_id, segment, epochs[(terms_id, segment)])
+                       for segment in segments if segment not in bitmaps])
+    return indexed
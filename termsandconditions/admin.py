@@ -2,25 +2,129 @@
 
 # pylint: disable=R0904
 
+from django import VERSION as DJANGO_VERSION
+from django.conf import settings
 from django.contrib import admin
-from django.utils.translation import gettext as _
-from .models import TermsAndConditions, UserTermsAndConditions
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from django.utils.translation import gettext as _, gettext_lazy
+from .exports import streaming_csv_response
+from .models import TermsAndConditions, TermsEmail, UserTermsAndConditions
 
+if DJANGO_VERSION >= (2, 0):
+    from django.urls import re_path
+else:  # pragma: nocover
+    from django.conf.urls import url as re_path
 
-class TermsAndConditionsAdmin(admin.ModelAdmin):
+TERMS_ADMIN_ESTIMATED_COUNT = getattr(settings, 'TERMS_ADMIN_ESTIMATED_COUNT', False)
+TERMS_ADMIN_ESTIMATED_COUNT_MIN = 10000
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator taking the row count of an unfiltered PostgreSQL table from the planner statistics.
+
+    Counting a large table exactly means scanning it, which is what makes big changelists slow. Filtered lists,
+    small tables and other databases are still counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        """Returns the estimated number of rows of large unfiltered tables, the exact number otherwise"""
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            connection = connections[self.object_list.db]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                                   [self.object_list.model._meta.db_table])
+                    row = cursor.fetchone()
+                if row and row[0] >= TERMS_ADMIN_ESTIMATED_COUNT_MIN:
+                    return int(row[0])
+        return super(EstimatedCountPaginator, self).count
+
+
+class DeferredFieldsChangeList(ChangeList):
+    """Changelist leaving the model admin's list_defer fields out of its query"""
+
+    def get_queryset(self, request, *args, **kwargs):
+        # Django 5.0+ passes exclude_parameters when counting list filter facets
+        queryset = super(DeferredFieldsChangeList, self).get_queryset(request, *args, **kwargs)
+        return queryset.defer(*self.model_admin.list_defer)
+
+
+class DeferredFieldsAdminMixin(object):
+    """Uses DeferredFieldsChangeList, so large fields that are not listed are never loaded for the changelist"""
+    list_defer = ()
+
+    def get_changelist(self, request, **kwargs):
+        return DeferredFieldsChangeList
+
+
+class TermsAndConditionsAdmin(DeferredFieldsAdminMixin, admin.ModelAdmin):
     """Sets up the custom Terms and Conditions admin display"""
     list_display = ('slug', 'name', 'date_active', 'version_number',)
+    list_defer = ('text', 'info',)
     verbose_name = _("Terms and Conditions")
 
 
-class UserTermsAndConditionsAdmin(admin.ModelAdmin):
+class UserTermsAndConditionsAdmin(DeferredFieldsAdminMixin, admin.ModelAdmin):
     """Sets up the custom User Terms and Conditions admin display"""
     # fields = ('terms', 'user', 'date_accepted', 'ip_address',)
     readonly_fields = ('date_accepted',)
+    raw_id_fields = ('user', 'terms',)
     list_display = ('terms', 'user', 'date_accepted', 'ip_address',)
-    date_hierarchy = 'date_accepted'
-    list_select_related = True
+    # Range filters on the indexed date instead of date_hierarchy, which aggregates the dates of the whole table
+    list_filter = (('date_accepted', admin.DateFieldListFilter),)
+    list_select_related = ('terms', 'user',)
+    list_defer = ('terms__text', 'terms__info',)
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator if TERMS_ADMIN_ESTIMATED_COUNT else Paginator
+    actions = ['download_csv']
+
+    def get_urls(self):
+        """Adds the CSV download of the filtered changelist, linked from the changelist object tools"""
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            re_path(r'^export/$', self.admin_site.admin_view(self.export_view), name='%s_%s_export' % info),
+        ] + super(UserTermsAndConditionsAdmin, self).get_urls()
+
+    def export_view(self, request):
+        """Streams every acceptance matching the changelist's current filters and search as CSV"""
+        if hasattr(self, 'has_view_or_change_permission'):
+            allowed = self.has_view_or_change_permission(request)
+        else:  # pragma: nocover
+            allowed = self.has_change_permission(request)
+        if not allowed:
+            raise PermissionDenied
+
+        if hasattr(self, 'get_changelist_instance'):
+            queryset = self.get_changelist_instance(request).get_queryset(request)
+        else:  # pragma: nocover
+            # Before Django 2.0 there is no simple way to rebuild the changelist, so export everything
+            queryset = self.get_queryset(request)
+        return streaming_csv_response(queryset)
+
+    def download_csv(self, request, queryset):
+        """Admin action streaming the selected acceptances as CSV"""
+        return streaming_csv_response(queryset)
+    download_csv.short_description = gettext_lazy("Download selected as CSV")
+
+
+class TermsEmailAdmin(DeferredFieldsAdminMixin, admin.ModelAdmin):
+    """Sets up the Terms Email admin display, showing how queued emails were delivered"""
+    list_display = ('recipient', 'terms', 'status', 'attempts', 'date_created', 'date_sent',)
+    list_filter = ('status',)
+    list_select_related = ('terms',)
+    list_defer = ('body', 'terms__text', 'terms__info',)
+    raw_id_fields = ('terms',)
+    readonly_fields = ('attempts', 'error', 'date_created', 'date_sent',)
+    search_fields = ('recipient',)
 
 
 admin.site.register(TermsAndConditions, TermsAndConditionsAdmin)
 admin.site.register(UserTermsAndConditions, UserTermsAndConditionsAdmin)
+admin.site.register(TermsEmail, TermsEmailAdmin)
@@ -0,0 +1,111 @@
+"""
+Async tests for the termsandconditions module.
+
+Kept out of tests.py, which Python 2 must still parse, and imported from there on Django 3.1+.
+"""
+
+# pylint: disable=R0904, C0103
+from unittest import skipUnless
+
+from asgiref.sync import sync_to_async
+from django import VERSION as DJANGO_VERSION
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, TestCase
+
+from . import asynchronous
+from .memo import get_not_agreed_terms_ids
+from .middleware import TermsAndConditionsRedirectMiddleware
+from .models import TermsAndConditions, UserTermsAndConditions
+
+
+async def get_response(request):
+    """Stands for the view behind the middleware"""
+    return HttpResponse('ok')
+
+
+@skipUnless(DJANGO_VERSION >= (5, 0), 'The async checks need request.auser(), added in Django 5.0')
+class TermsAndConditionsAsyncTestCase(TestCase):
+    """Tests the async middleware, which checks users who agreed to all terms without leaving the event loop"""
+
+    def setUp(self):
+        """Setup for each test"""
+        self.user1 = User.objects.create_user('user1', 'user1@user1.com', 'user1password')
+        self.terms1 = TermsAndConditions.objects.create(id=1, slug="site-terms", name="Site Terms",
+                                                        text="Site Terms and Conditions 1", version_number=1.0,
+                                                        date_active="2012-01-01")
+        cache.clear()
+
+        # Records what leaves the event loop for a thread
+        self.sync_calls = []
+        original_sync_to_async = asynchronous.sync_to_async
+
+        def recording_sync_to_async(func, **kwargs):
+            """Records the name of func before wrapping it"""
+            self.sync_calls.append(func.__name__)
+            return original_sync_to_async(func, **kwargs)
+
+        asynchronous.sync_to_async = recording_sync_to_async
+        self.addCleanup(setattr, asynchronous, 'sync_to_async', original_sync_to_async)
+
+    def _make_request(self, path, with_auser=True):
+        """Builds an ASGI request from user1, as left by the authentication middleware"""
+        request = AsyncRequestFactory().get(path)
+        request.user = self.user1
+        if with_auser:
+            async def auser():
+                """Returns the request's user"""
+                return self.user1
+            request.auser = auser
+        return request
+
+    async def test_aget_active_terms_ids_not_agreed_to(self):
+        """Test users who agreed to all terms are answered from the cache alone, others by the sync lookup"""
+        self.assertEqual((1,), await asynchronous.aget_active_terms_ids_not_agreed_to(self.user1))
+        self.assertEqual(['get_active_terms_ids_not_agreed_to'], self.sync_calls)
+
+        await sync_to_async(UserTermsAndConditions.accept_terms)(self.user1, [1])
+        del self.sync_calls[:]
+        self.assertEqual((), await asynchronous.aget_active_terms_ids_not_agreed_to(self.user1))
+        self.assertEqual(['get_active_terms_ids_not_agreed_to'], self.sync_calls)
+
+        del self.sync_calls[:]
+        self.assertEqual((), await asynchronous.aget_active_terms_ids_not_agreed_to(self.user1))
+        self.assertEqual([], self.sync_calls)
+
+    async def test_middleware(self):
+        """Test the async middleware redirects through the sync check, and lets agreed users through in the loop"""
+        middleware = TermsAndConditionsRedirectMiddleware(get_response)
+
+        response = await middleware(self._make_request('/secure/'))
+        self.assertEqual(302, response.status_code)
+        self.assertEqual('/terms/accept/site-terms?returnTo=/secure/', response['Location'])
+        self.assertEqual(['get_active_terms_ids_not_agreed_to', 'process_request'], self.sync_calls)
+
+        await sync_to_async(UserTermsAndConditions.accept_terms)(self.user1, [1])
+        del self.sync_calls[:]
+        response = await middleware(self._make_request('/secure/'))
+        self.assertEqual(b'ok', response.content)
+        self.assertEqual(['get_active_terms_ids_not_agreed_to'], self.sync_calls)
+
+        del self.sync_calls[:]
+        request = self._make_request('/secure/')
+        response = await middleware(request)
+        self.assertEqual(b'ok', response.content)
+        self.assertEqual([], self.sync_calls)
+        # The answer is kept on the request for the view
+        self.assertEqual((), get_not_agreed_terms_ids(request))
+
+        # Unprotected paths are not checked at all
+        response = await middleware(self._make_request('/terms/'))
+        self.assertEqual(b'ok', response.content)
+        self.assertEqual([], self.sync_calls)
+
+    async def test_middleware_without_auser(self):
+        """Test requests without request.auser() fall back to the sync check in a thread"""
+        middleware = TermsAndConditionsRedirectMiddleware(get_response)
+
+        response = await middleware(self._make_request('/secure/', with_auser=False))
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(['process_request'], self.sync_calls)
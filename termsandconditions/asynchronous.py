@@ -0,0 +1,67 @@
+"""
+Asynchronous support for the termsandconditions module.
+
+Only imported on Django 3.1+, which runs on Python 3 and can call middleware natively under ASGI.
+"""
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+
+from .caching import TERMS_GENERATION_CACHE_KEY, not_agreed_terms_cache_key
+from .memo import remember_not_agreed_terms_ids
+from .models import TermsAndConditions
+from .tokens import get_acceptance_token_mode
+
+
+async def aget_active_terms_ids_not_agreed_to(user):
+    """
+    Async version of TermsAndConditions.get_active_terms_ids_not_agreed_to.
+
+    A user whose cached entry shows they agreed to everything is answered with the async cache API alone.
+    Anything else needs the ORM and runs the sync lookup in a thread.
+    """
+    if user.pk is None:
+        return ()
+
+    if hasattr(cache, 'aget_many'):
+        not_agreed_terms_key = not_agreed_terms_cache_key(user.pk)
+        cached = await cache.aget_many([TERMS_GENERATION_CACHE_KEY, not_agreed_terms_key])
+        generation = cached.get(TERMS_GENERATION_CACHE_KEY)
+        if generation is not None and cached.get(not_agreed_terms_key) == (generation, ()):
+            return ()
+
+    return await sync_to_async(TermsAndConditions.get_active_terms_ids_not_agreed_to)(user)
+
+
+class AsyncRedirectMiddlewareMixin(object):
+    """Lets TermsAndConditionsRedirectMiddleware check ASGI requests without leaving the event loop"""
+
+    async def __acall__(self, request):
+        """Called instead of __call__ when the rest of the middleware chain is async"""
+        response = await self.aprocess_request(request)
+        if response is None:
+            response = await self.get_response(request)
+        return self.process_response(request, response)
+
+    async def aprocess_request(self, request):
+        """Async version of process_request, redirects are rare and left to the sync version"""
+        from .middleware import is_path_protected
+
+        if not hasattr(request, 'auser') or get_acceptance_token_mode():
+            # Without request.auser (Django 5.0+), loading the user or the session needs the sync ORM
+            return await sync_to_async(self.process_request, thread_sensitive=True)(request)
+
+        if not is_path_protected(request.META['PATH_INFO']):
+            return None
+
+        user = await request.auser()
+        if not user.is_authenticated:
+            return None
+
+        # Kept on the request, so the sync check and the view do not look it up again
+        not_agreed_terms_ids = await aget_active_terms_ids_not_agreed_to(user)
+        remember_not_agreed_terms_ids(request, user, not_agreed_terms_ids)
+        if not not_agreed_terms_ids:
+            return None
+
+        return await sync_to_async(self.process_request, thread_sensitive=True)(request)
@@ -0,0 +1,294 @@
+"""Cache key helpers for the termsandconditions module"""
+
+import hashlib
+import logging
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+
+from django import template
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.utils.encoding import force_bytes
+
+from . import metrics
+
+LOGGER = logging.getLogger(name='termsandconditions')
+TERMS_GENERATION_CACHE_KEY = 'tandc.terms_generation'
+
+
+def _new_generation():
+    """Seeds a generation from the clock, so a counter lost to eviction never reuses an old value"""
+    return int(time.time() * 1000)
+
+
+def prefetch(keys):
+    """Fetches several keys in one cache round trip, returns a dict holding every key, with None for missing ones"""
+    values = dict.fromkeys(keys)
+    values.update(cache.get_many(keys))
+    return values
+
+
+def cache_get(key, cached=None):
+    """Returns the cached value of key, taken from the values of prefetch() if they include it"""
+    if cached is not None and key in cached:
+        return cached[key]
+    return cache.get(key)
+
+
+def get_terms_generation(cached=None):
+    """Returns the current terms generation, starting one if the cache holds none"""
+    generation = cache_get(TERMS_GENERATION_CACHE_KEY, cached)
+    if generation is None:
+        generation = _new_generation()
+        if not cache.add(TERMS_GENERATION_CACHE_KEY, generation, None):
+            # Another process started the generation first, use theirs
+            generation = cache.get(TERMS_GENERATION_CACHE_KEY, generation)
+    return generation
+
+
+def after_commit(func, *args):
+    """Calls func(*args) once the current transaction is committed, at once outside of a transaction"""
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(lambda: func(*args))
+    else:  # pragma: nocover
+        func(*args)
+
+
+def bump_terms_generation():
+    """Starts a new terms generation, which makes every per-user entry of the previous one stale"""
+    try:
+        return cache.incr(TERMS_GENERATION_CACHE_KEY)
+    except ValueError:
+        generation = _new_generation()
+        cache.set(TERMS_GENERATION_CACHE_KEY, generation, None)
+        return generation
+
+
+def not_agreed_terms_cache_key(user_pk):
+    """
+    Returns the cache key holding the terms a user has not agreed to, along with the generation they were found in.
+
+    The generation is kept in the value rather than in the key, so the key is known without asking the cache first
+    and can be fetched together with the generation. The user pk is hashed so keys stay short and memcached-safe
+    whatever the user model's primary key is.
+    """
+    return 'tandc.not_agreed_terms_{0}'.format(hashlib.md5(force_bytes(user_pk)).hexdigest())
+
+
+def terms_version_cache_key(slug, version_number, generation=None):
+    """
+    Returns the cache key holding one version of the terms with slug in the given generation.
+
+    The version number is normalized so that 1, 1.0 and 1.00 share a key. Raises decimal.InvalidOperation if it is
+    not a number.
+    """
+    if generation is None:
+        generation = get_terms_generation()
+    return 'tandc.version_{0}_{1}_{2}'.format(generation, slug, Decimal(str(version_number)).normalize())
+
+
+def _refresh_is_due(entry, now):
+    """
+    Returns True if a cached (value, expires, compute_seconds, generation) entry should be recomputed now.
+
+    Besides expired entries, this answers True at random shortly before expiry, more often the closer the expiry and
+    the longer the value took to compute (the XFetch rule, scaled by TERMS_EARLY_REFRESH_BETA; 0 disables it). That
+    spreads refreshes out instead of having every worker notice the expiry at once.
+    """
+    value, expires, compute_seconds, generation = entry
+    beta = getattr(settings, 'TERMS_EARLY_REFRESH_BETA', 1.0)
+    return now - compute_seconds * beta * math.log(1.0 - random.random()) >= expires
+
+
+def _recompute_and_store(key, recompute, lookup, generation):
+    """
+    Runs recompute, caches the value it returns for the timeout it returns, and returns the value.
+
+    generation must be read before recompute runs: a value computed from data a terms change has since replaced then
+    belongs to the previous generation, and is not served even if it is stored after the change cleared its key.
+    """
+    started = time.time()
+    with metrics.recompute(lookup):
+        value, timeout = recompute()
+    now = time.time()
+    # Kept past its expiry, so other workers can serve it while one of them recomputes it
+    cache.set(key, (value, now + timeout, now - started, generation),
+              timeout + getattr(settings, 'TERMS_REFRESH_LOCK_SECONDS', 10) +
+              getattr(settings, 'TERMS_STALE_WHILE_REVALIDATE_SECONDS', 0))
+    return value
+
+
+def _refresh_in_background(key, recompute, lookup, generation, lock_key):
+    """Recomputes and caches a value in a new thread, releasing the refresh lock when done; returns the thread"""
+
+    def refresh():
+        """Runs the refresh, with its own database connection"""
+        try:
+            _recompute_and_store(key, recompute, lookup, generation)
+        except Exception:  # pylint: disable=W0703
+            LOGGER.exception("Refreshing %s in the background failed", key)
+        finally:
+            cache.delete(lock_key)
+            connections.close_all()
+
+    thread = threading.Thread(target=refresh, name='terms-refresh')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _current_entry(entry, generation):
+    """Returns entry if it was computed in the given terms generation, None otherwise"""
+    if entry is not None and entry[3] == generation:
+        return entry
+    return None
+
+
+def get_or_recompute(key, recompute, lookup, cached=None):
+    """
+    Returns the value cached under key, with a single worker recomputing it when it expires.
+
+    recompute() returns the new value and how many seconds it may be cached for. Only the worker taking the refresh
+    lock, for up to TERMS_REFRESH_LOCK_SECONDS, recomputes; the others keep serving the previous value meanwhile, or
+    wait up to TERMS_REFRESH_WAIT_SECONDS for the new one if there is none, recomputing it themselves after that.
+
+    With TERMS_STALE_WHILE_REVALIDATE_SECONDS, values are kept that much longer past their expiry, and the worker
+    taking the lock also answers with the previous value at once, recomputing it in a background thread.
+
+    Values of a previous terms generation are never served, so a recompute that was running when terms were saved
+    cannot outlive the save. cached holds values already fetched by prefetch(), which saves a round trip if it
+    includes key and the generation; otherwise both are fetched together.
+    """
+    if cached is None or key not in cached or TERMS_GENERATION_CACHE_KEY not in cached:
+        cached = prefetch([TERMS_GENERATION_CACHE_KEY, key])
+    generation = get_terms_generation(cached)
+    entry = _current_entry(cached[key], generation)
+    if entry is not None and not _refresh_is_due(entry, time.time()):
+        metrics.hit(lookup)
+        return entry[0]
+
+    lock_key = key + '.lock'
+    if cache.add(lock_key, True, getattr(settings, 'TERMS_REFRESH_LOCK_SECONDS', 10)):
+        if entry is not None and getattr(settings, 'TERMS_STALE_WHILE_REVALIDATE_SECONDS', 0) > 0:
+            _refresh_in_background(key, recompute, lookup, generation, lock_key)
+            metrics.hit(lookup)
+            return entry[0]
+        try:
+            return _recompute_and_store(key, recompute, lookup, generation)
+        finally:
+            cache.delete(lock_key)
+
+    if entry is None:
+        deadline = time.time() + getattr(settings, 'TERMS_REFRESH_WAIT_SECONDS', 1)
+        while entry is None and time.time() < deadline:
+            time.sleep(0.05)
+            entry = _current_entry(cache.get(key), generation)
+        if entry is None:
+            return _recompute_and_store(key, recompute, lookup, generation)
+
+    metrics.hit(lookup)
+    return entry[0]
+
+
+class LocalSnapshot(object):
+    """
+    Per-process copy of global terms values, such as the active terms ids and list.
+
+    Values are only served while the snapshot is younger than TERMS_LOCAL_CACHE_SECONDS and belongs to the
+    current terms generation, so a terms change in any process is picked up on the next generation check.
+    Readers never lock; writers replace the whole state at once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = (None, 0, {})
+
+    @staticmethod
+    def is_enabled():
+        """Returns True if the local snapshot has been switched on in the settings"""
+        return getattr(settings, 'TERMS_LOCAL_CACHE_SECONDS', 0) > 0
+
+    def get(self, key, generation):
+        """Returns the value stored for key in the given generation, or None"""
+        state_generation, expires, values = self._state
+        if state_generation != generation or time.time() >= expires:
+            return None
+        return values.get(key)
+
+    def set(self, key, value, generation, timeout=None):
+        """Stores a value for key, starting a fresh snapshot if the current one is stale
+
+        A timeout shorter than TERMS_LOCAL_CACHE_SECONDS brings the expiry of the whole snapshot forward.
+        """
+        with self._lock:
+            state_generation, expires, values = self._state
+            now = time.time()
+            if state_generation != generation or now >= expires:
+                expires = now + getattr(settings, 'TERMS_LOCAL_CACHE_SECONDS', 0)
+                values = {}
+            if timeout is not None:
+                expires = min(expires, now + timeout)
+            values = dict(values)
+            values[key] = value
+            self._state = (generation, expires, values)
+
+    def clear(self):
+        """Drops everything held by the snapshot"""
+        with self._lock:
+            self._state = (None, 0, {})
+
+
+local_snapshot = LocalSnapshot()
+
+
+class CompiledTemplateCache(object):
+    """
+    Per-process cache of compiled templates, keyed by a hash of their source.
+
+    Terms texts may hold template tags and are rendered through the as_template filter. Parsing them is the costly
+    part, and a given text always compiles to the same template, so each one is parsed once per process. The least
+    recently used templates are dropped beyond TERMS_TEMPLATE_CACHE_SIZE entries.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._templates = OrderedDict()
+
+    @staticmethod
+    def get_max_size():
+        """Returns the number of compiled templates kept, 0 disables the cache"""
+        return getattr(settings, 'TERMS_TEMPLATE_CACHE_SIZE', 32)
+
+    def get(self, source):
+        """Returns the compiled template for source, parsing it only if it is not cached yet"""
+        max_size = self.get_max_size()
+        if max_size <= 0:
+            return template.Template(source)
+
+        key = hashlib.sha1(force_bytes(source)).hexdigest()
+        with self._lock:
+            compiled = self._templates.pop(key, None)
+            if compiled is not None:
+                # Reinsert to mark it as most recently used
+                self._templates[key] = compiled
+                return compiled
+
+        compiled = template.Template(source)
+        with self._lock:
+            self._templates[key] = compiled
+            while len(self._templates) > max_size:
+                self._templates.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        """Drops every compiled template"""
+        with self._lock:
+            self._templates.clear()
+
+
+compiled_templates = CompiledTemplateCache()
@@ -4,8 +4,11 @@ from future.moves.urllib.parse import urlparse, urlunparse
 from functools import wraps
 from django.http import HttpResponseRedirect, QueryDict
 from django.utils.decorators import available_attrs
+from . import metrics
 from .models import TermsAndConditions
+from .memo import get_not_agreed_terms_ids
 from .middleware import ACCEPT_TERMS_PATH
+from .tokens import get_acceptance_token_mode, has_acceptance_token, set_acceptance_token, save_acceptance_token
 
 
 def terms_required(view_func):
@@ -22,10 +25,23 @@ def terms_required(view_func):
         else:
             user_authenticated = request.user.is_authenticated
 
-        if not user_authenticated or not TermsAndConditions.get_active_terms_not_agreed_to(request.user):
+        if not user_authenticated:
             return view_func(request, *args, **kwargs)
 
+        active_terms_ids = None
+        if get_acceptance_token_mode():
+            active_terms_ids = TermsAndConditions.get_active_terms_ids()
+            if has_acceptance_token(request, active_terms_ids):
+                return view_func(request, *args, **kwargs)
+
+        if not get_not_agreed_terms_ids(request):
+            if active_terms_ids is None:
+                return view_func(request, *args, **kwargs)
+            set_acceptance_token(request, request.user, active_terms_ids)
+            return save_acceptance_token(request, view_func(request, *args, **kwargs))
+
         # Otherwise, redirect to terms accept
+        metrics.redirect('decorator')
         current_path = request.path
         login_url_parts = list(urlparse(ACCEPT_TERMS_PATH))
         querystring = QueryDict(login_url_parts[4], mutable=True)
@@ -0,0 +1,98 @@
+"""Helpers shared by the acceptance export and import commands"""
+
+import datetime
+import timeit
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+
+def add_filter_arguments(parser):
+    """Adds the options selecting which acceptances to handle"""
+    parser.add_argument('--slug', action='append', dest='slugs', default=[],
+                        help='Only acceptances of terms with this slug, may be repeated.')
+    parser.add_argument('--terms-version', dest='version_number',
+                        help='Only acceptances of this version number.')
+    parser.add_argument('--since', help='Only acceptances on or after this date or datetime.')
+    parser.add_argument('--until', help='Only acceptances before this date or datetime.')
+    parser.add_argument('--progress-every', type=int, default=100000,
+                        help='Report progress after this many rows, 0 for a final summary only.')
+
+
+def parse_moment(value, option):
+    """Parses a date or datetime option into a datetime, aware if USE_TZ is on"""
+    if not value:
+        return None
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise CommandError('{0} must be a date or datetime, not {1!r}'.format(option, value))
+        moment = datetime.datetime(day.year, day.month, day.day)
+    if settings.USE_TZ and timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def parse_version(value):
+    """Parses a version number so that 1.0 and 1.00 compare equal"""
+    try:
+        return Decimal(value) if value not in (None, '') else None
+    except InvalidOperation:
+        raise CommandError('Invalid version number {0!r}'.format(value))
+
+
+class AcceptanceFilter(object):
+    """Filters acceptances by slug, version and date range, on querysets and on imported rows"""
+
+    def __init__(self, options):
+        self.slugs = set(options['slugs'])
+        self.version_number = parse_version(options['version_number'])
+        self.since = parse_moment(options['since'], '--since')
+        self.until = parse_moment(options['until'], '--until')
+
+    def filter_queryset(self, queryset):
+        """Returns the UserTermsAndConditions queryset narrowed down by the filters"""
+        if self.slugs:
+            queryset = queryset.filter(terms__slug__in=self.slugs)
+        if self.version_number is not None:
+            queryset = queryset.filter(terms__version_number=self.version_number)
+        if self.since is not None:
+            queryset = queryset.filter(date_accepted__gte=self.since)
+        if self.until is not None:
+            queryset = queryset.filter(date_accepted__lt=self.until)
+        return queryset
+
+    def matches(self, slug, version_number, date_accepted):
+        """Returns True if an imported row passes the filters"""
+        return ((not self.slugs or slug in self.slugs) and
+                (self.version_number is None or version_number == self.version_number) and
+                (self.since is None or date_accepted >= self.since) and
+                (self.until is None or date_accepted < self.until))
+
+
+class Progress(object):
+    """Counts rows and reports the count and throughput to a stream"""
+
+    def __init__(self, stream, verb, every):
+        self.stream = stream
+        self.verb = verb
+        self.every = every
+        self.rows = 0
+        self.started = timeit.default_timer()
+
+    def add(self, rows=1):
+        """Counts rows, reporting each time another `every` rows have been handled"""
+        before = self.rows
+        self.rows += rows
+        if self.every and before // self.every != self.rows // self.every:
+            self.report()
+
+    def report(self, extra=''):
+        """Writes the number of rows so far and the rate they were handled at"""
+        elapsed = max(timeit.default_timer() - self.started, 1e-9)
+        self.stream.write('{0} {1} rows in {2:.1f}s ({3:.0f} rows/s){4}'.format(
+            self.verb, self.rows, elapsed, self.rows / elapsed, extra))
@@ -0,0 +1,49 @@
+"""Builds the acceptance index from the recorded acceptances"""
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+
+from ... import acceptance_index
+from ...models import TermsAndConditions, UserTermsAndConditions
+from ._acceptances import Progress
+
+
+class Command(BaseCommand):
+    """
+    Replaces the acceptance bitmaps of terms versions with ones read from the database.
+
+    Acceptances are indexed as they are recorded, so this is needed once when the index is set up, and after anything
+    the signals do not see, such as imports, or the index cache being cleared.
+    """
+    help = 'Builds the acceptance index of the active terms, or of every version with --all-versions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--slug', action='append', dest='slugs', default=[],
+                            help='Only terms with this slug, may be repeated.')
+        parser.add_argument('--all-versions', action='store_true', help='Index every version, not only active ones.')
+        parser.add_argument('--progress-every', type=int, default=100000,
+                            help='Report progress after this many acceptances, 0 for a final summary only.')
+
+    def handle(self, *args, **options):
+        if acceptance_index.get_index_cache() is None:
+            raise CommandError('The acceptance index is not enabled, set TERMS_ACCEPTANCE_INDEX to a cache name')
+
+        if options['all_versions']:
+            terms_ids = TermsAndConditions.objects.values_list('pk', flat=True)
+        else:
+            terms_ids = TermsAndConditions.get_active_terms_ids()
+        if options['slugs']:
+            terms_ids = TermsAndConditions.objects.filter(
+                pk__in=list(terms_ids), slug__in=options['slugs']
+            ).values_list('pk', flat=True)
+
+        progress = Progress(self.stderr, 'Indexed', options['progress_every'])
+        terms_ids = list(terms_ids)
+        for terms_id in terms_ids:
+            # Read first, users created afterwards are indexed by the signals
+            max_user_pk = get_user_model().objects.aggregate(max_pk=Max('pk'))['max_pk']
+            user_pks = UserTermsAndConditions.objects.filter(terms_id=terms_id).values_list('user_id', flat=True)
+            progress.add(acceptance_index.build(terms_id, user_pks.iterator(), max_user_pk))
+
+        progress.report(' for {0} terms'.format(len(terms_ids)))
@@ -0,0 +1,48 @@
+"""Streams UserTermsAndConditions rows to a CSV or JSON lines file"""
+
+import csv
+import io
+import json
+
+from django.core.management.base import BaseCommand
+
+from ...exports import ACCEPTANCE_FIELDS, acceptance_rows
+from ...models import UserTermsAndConditions
+from ._acceptances import AcceptanceFilter, Progress, add_filter_arguments
+
+
+class Command(BaseCommand):
+    """Exports acceptances with constant memory, reading them in chunks through a server-side cursor where supported"""
+    help = 'Exports terms acceptances to CSV or JSON lines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=('csv', 'jsonl'), default='csv', help='Output format.')
+        parser.add_argument('--output', help='File to write to, defaults to stdout.')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched from the database at once.')
+        add_filter_arguments(parser)
+
+    def handle(self, *args, **options):
+        acceptances = AcceptanceFilter(options).filter_queryset(UserTermsAndConditions.objects.all())
+        rows = acceptance_rows(acceptances.order_by('pk'), options['chunk_size'])
+
+        if options['output']:
+            output = io.open(options['output'], 'w', encoding='utf-8', newline='')
+        else:
+            output = self.stdout
+        try:
+            progress = Progress(self.stderr, 'Exported', options['progress_every'])
+            if options['format'] == 'csv':
+                writer = csv.writer(output, lineterminator='\n')
+                writer.writerow(ACCEPTANCE_FIELDS)
+                for row in rows:
+                    writer.writerow(row)
+                    progress.add()
+            else:
+                for row in rows:
+                    output.write(u'{0}\n'.format(json.dumps(dict(zip(ACCEPTANCE_FIELDS, row)))))
+                    progress.add()
+        finally:
+            if output is not self.stdout:
+                output.close()
+
+        progress.report()
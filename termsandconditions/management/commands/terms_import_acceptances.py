@@ -0,0 +1,146 @@
+"""Bulk loads UserTermsAndConditions rows from a CSV or JSON lines file"""
+
+import csv
+import io
+import json
+import sys
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Case, DateTimeField, Value, When
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ...caching import bump_terms_generation
+from ...models import TermsAndConditions, UserTermsAndConditions, _bulk_create_ignore_conflicts
+from ._acceptances import AcceptanceFilter, Progress, add_filter_arguments, parse_version
+
+UPDATE_BATCH_SIZE = 300
+
+
+class Command(BaseCommand):
+    """Imports acceptances in batches, leaving out those that already exist"""
+    help = 'Imports terms acceptances from CSV or JSON lines, as written by terms_export_acceptances.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='File to read, or - for stdin.')
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+                            help='Input format, guessed from the file extension if not given.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows inserted at once.')
+        parser.add_argument('--match-user', choices=('username', 'user_id'), default='username',
+                            help='Column used to find the user of each row.')
+        add_filter_arguments(parser)
+
+    def handle(self, *args, **options):
+        input_format = options['format'] or ('jsonl' if options['input'].endswith(('.jsonl', '.json')) else 'csv')
+        if options['input'] == '-':
+            stream = sys.stdin
+        else:
+            stream = io.open(options['input'], encoding='utf-8', newline='')
+
+        self.acceptance_filter = AcceptanceFilter(options)
+        self.match_user = options['match_user']
+        self.terms_ids = dict(
+            ((slug, version_number), terms_id)
+            for terms_id, slug, version_number in TermsAndConditions.objects.values_list('pk', 'slug', 'version_number')
+        )
+        self.skipped = 0
+
+        progress = Progress(self.stderr, 'Imported', options['progress_every'])
+        try:
+            rows = csv.DictReader(stream) if input_format == 'csv' else (json.loads(line) for line in stream if line.strip())
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= options['batch_size']:
+                    progress.add(self.import_batch(batch))
+                    batch = []
+            if batch:
+                progress.add(self.import_batch(batch))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        # Bulk inserts send no signals, so make every cached per-user entry stale at once
+        bump_terms_generation()
+        progress.report(', skipped {0} rows with unknown users or terms, or outside the filters'.format(self.skipped))
+
+    def import_batch(self, rows):
+        """Inserts the acceptances of one batch of rows, returns how many rows were sent to the database"""
+        user_model = get_user_model()
+        if self.match_user == 'username':
+            lookup = user_model.USERNAME_FIELD
+            keys = set(row['username'] for row in rows)
+        else:
+            lookup = 'pk'
+            keys = set(int(row['user_id']) for row in rows)
+        user_ids = dict(user_model.objects.filter(**{lookup + '__in': keys}).values_list(lookup, 'pk'))
+
+        acceptances = []
+        for row in rows:
+            user_id = user_ids.get(row['username'] if self.match_user == 'username' else int(row['user_id']))
+            version_number = parse_version(row['version_number'])
+            terms_id = self.terms_ids.get((row['slug'], version_number))
+            date_accepted = self.parse_date_accepted(row['date_accepted'])
+            if user_id is None or terms_id is None or \
+                    not self.acceptance_filter.matches(row['slug'], version_number, date_accepted):
+                self.skipped += 1
+                continue
+            acceptances.append(UserTermsAndConditions(
+                user_id=user_id, terms_id=terms_id, ip_address=row['ip_address'] or None, date_accepted=date_accepted,
+            ))
+
+        self.insert_acceptances(acceptances)
+        return len(acceptances)
+
+    @staticmethod
+    def insert_acceptances(acceptances):
+        """
+        Inserts the acceptances which are not recorded yet, keeping their exported dates.
+
+        date_accepted is stamped with the time of insert, and switching that off on the shared model field would affect
+        every thread of the process, so the exported dates are set by an update of the rows just inserted instead.
+        """
+        users_ids = set(acceptance.user_id for acceptance in acceptances)
+        terms_ids = set(acceptance.terms_id for acceptance in acceptances)
+        recorded = set(UserTermsAndConditions.objects.filter(
+            user_id__in=users_ids, terms_id__in=terms_ids
+        ).values_list('user_id', 'terms_id'))
+        # Taken before the insert, which stamps the instances too
+        dates_accepted = dict(((acceptance.user_id, acceptance.terms_id), acceptance.date_accepted)
+                              for acceptance in acceptances
+                              if (acceptance.user_id, acceptance.terms_id) not in recorded)
+        if not dates_accepted:
+            return
+
+        _bulk_create_ignore_conflicts(UserTermsAndConditions, [
+            acceptance for acceptance in acceptances if (acceptance.user_id, acceptance.terms_id) in dates_accepted
+        ])
+
+        inserted = [
+            (pk, dates_accepted[(user_id, terms_id)])
+            for pk, user_id, terms_id in UserTermsAndConditions.objects.filter(
+                user_id__in=users_ids, terms_id__in=terms_ids
+            ).values_list('pk', 'user_id', 'terms_id')
+            if (user_id, terms_id) in dates_accepted
+        ]
+        # A few rows per update, to stay under the bound parameter limits of the database
+        for start in range(0, len(inserted), UPDATE_BATCH_SIZE):
+            chunk = inserted[start:start + UPDATE_BATCH_SIZE]
+            UserTermsAndConditions.objects.filter(pk__in=[pk for pk, date_accepted in chunk]).update(
+                date_accepted=Case(*[When(pk=pk, then=Value(date_accepted)) for pk, date_accepted in chunk],
+                                   output_field=DateTimeField())
+            )
+
+    @staticmethod
+    def parse_date_accepted(value):
+        """Parses an exported acceptance date, aware if USE_TZ is on"""
+        date_accepted = parse_datetime(value)
+        if date_accepted is None:
+            raise CommandError('Invalid date_accepted {0!r}'.format(value))
+        if settings.USE_TZ and timezone.is_naive(date_accepted):
+            date_accepted = timezone.make_aware(date_accepted)
+        elif not settings.USE_TZ and timezone.is_aware(date_accepted):
+            date_accepted = timezone.make_naive(date_accepted)
+        return date_accepted
@@ -0,0 +1,136 @@
+"""Emails the active version of some terms to every user who has not accepted it yet"""
+
+import io
+import json
+import os
+import time
+import timeit
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.core.mail import EmailMessage, get_connection
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.template.loader import get_template
+
+from ...models import DEFAULT_TERMS_SLUG, TERMS_EXCLUDE_USERS_WITH_PERM, TermsAndConditions
+from ._acceptances import Progress
+
+
+class Command(BaseCommand):
+    """
+    Notifies users of new terms in batches, each sent over the same mail connection.
+
+    The email is rendered once. Users are handled in primary key order, and with --state-file the last notified user
+    is saved after each batch, so an interrupted run resumes where it stopped; a batch cut short is sent again.
+    """
+    help = 'Emails the active terms of a slug to the active users who have not accepted them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--slug', default=DEFAULT_TERMS_SLUG, help='Slug of the terms to send.')
+        parser.add_argument('--subject', help='Email subject, defaults to the name of the terms.')
+        parser.add_argument('--batch-size', type=int, default=200, help='Emails handed to the mail backend at once.')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Maximum emails sent per second, 0 for no limit.')
+        parser.add_argument('--limit', type=int, default=0, help='Stop after this many emails, 0 for no limit.')
+        parser.add_argument('--state-file',
+                            help='File recording the last notified user, to resume an interrupted run from.')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the users who would be emailed.')
+        parser.add_argument('--progress-every', type=int, default=1000,
+                            help='Report progress after this many emails, 0 for a final summary only.')
+
+    def handle(self, *args, **options):
+        terms = TermsAndConditions.get_active(options['slug'])
+        if terms is None:
+            raise CommandError('There are no active terms with slug {0!r}'.format(options['slug']))
+
+        recipients = self.get_recipients(terms)
+        if options['dry_run']:
+            self.stdout.write('{0} users have not accepted {1}'.format(recipients.count(), terms))
+            return
+
+        last_pk = self.load_state(options['state_file'], terms)
+        body = get_template("termsandconditions/tc_email_terms.html").render({"terms": terms})
+        subject = options['subject'] or terms.name
+
+        progress = Progress(self.stderr, 'Emailed', options['progress_every'])
+        connection = get_connection()
+        connection.open()
+        try:
+            while not options['limit'] or progress.rows < options['limit']:
+                batch_size = options['batch_size']
+                if options['limit']:
+                    batch_size = min(batch_size, options['limit'] - progress.rows)
+                remaining = recipients if last_pk is None else recipients.filter(pk__gt=last_pk)
+                batch = list(remaining[:batch_size])
+                if not batch:
+                    break
+
+                connection.send_messages([
+                    EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL, [email], connection=connection)
+                    for user_pk, email in batch
+                ])
+                last_pk = batch[-1][0]
+                self.save_state(options['state_file'], terms, last_pk)
+                progress.add(len(batch))
+                self.throttle(progress, options['rate'])
+        finally:
+            connection.close()
+
+        progress.report(' of {0}'.format(terms))
+
+    @staticmethod
+    def get_recipients(terms):
+        """Returns (pk, email) pairs of the users to notify of terms, ordered by pk"""
+        user_model = get_user_model()
+        email_field = getattr(user_model, 'EMAIL_FIELD', 'email')
+        users = user_model.objects.filter(is_active=True).exclude(
+            **{email_field: ''}
+        ).exclude(
+            **{email_field + '__isnull': True}
+        ).exclude(userterms__terms=terms)
+
+        # Users excluded from the terms checks are not asked to accept them either
+        if TERMS_EXCLUDE_USERS_WITH_PERM is not None and hasattr(user_model, 'user_permissions'):
+            if '.' not in TERMS_EXCLUDE_USERS_WITH_PERM:
+                raise CommandError('TERMS_EXCLUDE_USERS_WITH_PERM must be "app_label.codename", not {0!r}'.format(
+                    TERMS_EXCLUDE_USERS_WITH_PERM))
+            app_label, codename = TERMS_EXCLUDE_USERS_WITH_PERM.split('.', 1)
+            # Resolved on its own, as lookups spanning a relation in exclude() need not match the same permission
+            permissions = Permission.objects.filter(content_type__app_label=app_label, codename=codename)
+            users = users.exclude(
+                Q(user_permissions__in=permissions) | Q(groups__permissions__in=permissions),
+                is_superuser=False,
+            )
+
+        return users.order_by('pk').values_list('pk', email_field)
+
+    @staticmethod
+    def load_state(state_file, terms):
+        """Returns the pk of the last user notified of terms by a previous run, or None"""
+        if not state_file or not os.path.exists(state_file):
+            return None
+        with io.open(state_file, encoding='utf-8') as stream:
+            state = json.load(stream)
+        if state.get('terms_id') != terms.pk:
+            # The state is about other terms, start over
+            return None
+        return state['last_user_pk']
+
+    @staticmethod
+    def save_state(state_file, terms, last_pk):
+        """Records the last user notified of terms, replacing the state file at once"""
+        if not state_file:
+            return
+        with io.open(state_file + '.tmp', 'w', encoding='utf-8') as stream:
+            stream.write(u'{0}'.format(json.dumps({'terms_id': terms.pk, 'last_user_pk': str(last_pk)})))
+        os.rename(state_file + '.tmp', state_file)
+
+    @staticmethod
+    def throttle(progress, rate):
+        """Sleeps as long as needed to keep the average sending rate under rate emails per second"""
+        if rate > 0:
+            delay = progress.started + progress.rows / rate - timeit.default_timer()
+            if delay > 0:
+                time.sleep(delay)
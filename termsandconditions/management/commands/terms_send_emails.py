@@ -0,0 +1,39 @@
+"""Delivers the terms emails waiting in the outbox"""
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from ...models import TermsEmail
+from ...outbox import deliver
+from ._acceptances import Progress
+
+
+class Command(BaseCommand):
+    """Sends pending emails, and retries failed ones, in batches over one mail connection each"""
+    help = 'Sends the terms emails waiting in the outbox, retrying failed ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Emails sent over one mail connection.')
+        parser.add_argument('--max-attempts', type=int, default=3,
+                            help='Give up on an email after this many failed attempts.')
+        parser.add_argument('--progress-every', type=int, default=1000,
+                            help='Report progress after this many emails, 0 for a final summary only.')
+
+    def handle(self, *args, **options):
+        waiting = TermsEmail.objects.exclude(status=TermsEmail.SENT).filter(
+            attempts__lt=options['max_attempts']
+        ).order_by('pk')
+
+        progress = Progress(self.stderr, 'Sent', options['progress_every'])
+        failed = 0
+        last_pk = 0
+        while True:
+            batch = list(waiting.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            sent = deliver(batch, get_connection())
+            failed += TermsEmail.objects.filter(pk__in=[email.pk for email in batch], status=TermsEmail.FAILED).count()
+            progress.add(sent)
+
+        progress.report(', {0} failed'.format(failed))
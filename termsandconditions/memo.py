@@ -0,0 +1,49 @@
+"""
+Request-scoped memo of the terms a user has not agreed to.
+
+The middleware, the decorator, the template tag and the views all need the same answer for the same request, so it
+is looked up once, lazily, and kept on the request for as long as its user stays the same.
+"""
+
+from .models import TermsAndConditions
+
+REQUEST_MEMO_ATTRIBUTE = '_terms_not_agreed_memo'
+
+
+def _get_memo(request):
+    """Returns the memo kept on request, if it is about the request's current user"""
+    memo = getattr(request, REQUEST_MEMO_ATTRIBUTE, None)
+    if memo is not None and memo['user_pk'] == request.user.pk:
+        return memo
+    return None
+
+
+def remember_not_agreed_terms_ids(request, user, terms_ids):
+    """Keeps the ids of the active terms user has not agreed to on request, returns the memo"""
+    memo = {'user_pk': user.pk, 'terms_ids': terms_ids, 'terms': None}
+    setattr(request, REQUEST_MEMO_ATTRIBUTE, memo)
+    return memo
+
+
+def get_not_agreed_terms_ids(request):
+    """Returns the ids of the active terms request.user has not agreed to, looked up at most once per request"""
+    memo = _get_memo(request)
+    if memo is None:
+        memo = remember_not_agreed_terms_ids(
+            request, request.user, TermsAndConditions.get_active_terms_ids_not_agreed_to(request.user))
+    return memo['terms_ids']
+
+
+def get_not_agreed_terms(request):
+    """Returns the active terms request.user has not agreed to, looked up at most once per request"""
+    terms_ids = get_not_agreed_terms_ids(request)
+    memo = _get_memo(request)
+    if memo['terms'] is None:
+        memo['terms'] = TermsAndConditions.get_active_terms_by_ids(terms_ids)
+    return memo['terms']
+
+
+def forget_not_agreed_terms(request):
+    """Drops the memo from request, for when the user has just accepted terms"""
+    if hasattr(request, REQUEST_MEMO_ATTRIBUTE):
+        delattr(request, REQUEST_MEMO_ATTRIBUTE)
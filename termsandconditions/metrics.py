@@ -0,0 +1,130 @@
+"""
+Metrics for the termsandconditions module.
+
+Cached lookups report hits and misses (with the time and database queries spent recomputing) to a collector,
+and the middleware and decorator report the redirects they issue. The collector class is set with
+TERMS_METRICS_COLLECTOR, a dotted path, and None switches metrics off. The default InProcessCollector keeps
+counters in the process and renders them in the Prometheus text format for MetricsView.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+import timeit
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+DEFAULT_TERMS_METRICS_COLLECTOR = 'termsandconditions.metrics.InProcessCollector'
+
+_collector = []
+
+
+class InProcessCollector(object):
+    """Counts lookups and redirects in memory, for this process only"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Sets all counters back to zero"""
+        with self._lock:
+            self.counters = defaultdict(int)
+
+    def _add(self, name, label, value=1):
+        """Adds value to the counter name{label}"""
+        with self._lock:
+            self.counters[(name, label)] += value
+
+    def hit(self, lookup):
+        """Called when a lookup is served from the cache"""
+        self._add('cache_hits_total', lookup)
+
+    def miss(self, lookup, seconds, queries):
+        """Called when a lookup had to be recomputed, with the time and queries that took"""
+        self._add('cache_misses_total', lookup)
+        self._add('recompute_seconds_total', lookup, seconds)
+        self._add('recompute_queries_total', lookup, queries)
+
+    def redirect(self, source):
+        """Called when a user is sent to accept terms, source is 'middleware' or 'decorator'"""
+        self._add('redirects_total', source)
+
+    def render(self):
+        """Returns the counters in the Prometheus text exposition format"""
+        with self._lock:
+            counters = sorted(self.counters.items())
+
+        lines = []
+        for name, label_name in (('cache_hits_total', 'lookup'), ('cache_misses_total', 'lookup'),
+                                 ('recompute_seconds_total', 'lookup'), ('recompute_queries_total', 'lookup'),
+                                 ('redirects_total', 'source')):
+            lines.append('# TYPE termsandconditions_{0} counter'.format(name))
+            for (counter_name, label), value in counters:
+                if counter_name == name:
+                    lines.append('termsandconditions_{0}{{{1}="{2}"}} {3}'.format(name, label_name, label, value))
+        return '\n'.join(lines) + '\n'
+
+
+def get_collector():
+    """Returns the configured collector, or None if metrics are switched off"""
+    if not _collector:
+        path = getattr(settings, 'TERMS_METRICS_COLLECTOR', DEFAULT_TERMS_METRICS_COLLECTOR)
+        _collector.append(import_string(path)() if path else None)
+    return _collector[0]
+
+
+@receiver(setting_changed)
+def reset_collector(setting, **kwargs):
+    """Loads the collector again after TERMS_METRICS_COLLECTOR is changed, as tests do"""
+    if setting == 'TERMS_METRICS_COLLECTOR':
+        del _collector[:]
+
+
+def hit(lookup):
+    """Records a lookup served from the cache"""
+    collector = get_collector()
+    if collector is not None:
+        collector.hit(lookup)
+
+
+def redirect(source):
+    """Records a redirect to the accept page"""
+    collector = get_collector()
+    if collector is not None:
+        collector.redirect(source)
+
+
+class _QueryCounter(object):
+    """Database execute wrapper counting the queries run through it"""
+
+    def __init__(self):
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def recompute(lookup):
+    """Records a lookup missing the cache, timing the block and counting its queries (Django 2.0+)"""
+    collector = get_collector()
+    if collector is None:
+        yield
+        return
+
+    counter = _QueryCounter()
+    started = timeit.default_timer()
+    try:
+        if hasattr(connection, 'execute_wrapper'):
+            with connection.execute_wrapper(counter):
+                yield
+        else:  # pragma: nocover
+            yield
+    finally:
+        collector.miss(lookup, timeit.default_timer() - started, counter.queries)
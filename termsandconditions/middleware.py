@@ -1,8 +1,12 @@
 """Terms and Conditions Middleware"""
+from . import metrics
+from .memo import get_not_agreed_terms
 from .models import TermsAndConditions
 from django.conf import settings
 import logging
+import re
 from .pipeline import redirect_to_terms_accept
+from .tokens import get_acceptance_token_mode, has_acceptance_token, set_acceptance_token, save_acceptance_token
 from django import VERSION as DJANGO_VERSION
 
 if DJANGO_VERSION >= (1, 10, 0):
@@ -10,18 +14,27 @@ if DJANGO_VERSION >= (1, 10, 0):
 else:
     MiddlewareMixin = object
 
+if DJANGO_VERSION >= (3, 1, 0):
+    from .asynchronous import AsyncRedirectMiddlewareMixin
+else:
+    class AsyncRedirectMiddlewareMixin(object):
+        """Older Django versions only call middleware synchronously"""
+
 LOGGER = logging.getLogger(name='termsandconditions')
 
 ACCEPT_TERMS_PATH = getattr(settings, 'ACCEPT_TERMS_PATH', '/terms/accept/')
 TERMS_EXCLUDE_URL_PREFIX_LIST = getattr(settings, 'TERMS_EXCLUDE_URL_PREFIX_LIST', {'/admin', '/terms'})
 TERMS_EXCLUDE_URL_CONTAINS_LIST = getattr(settings, 'TERMS_EXCLUDE_URL_CONTAINS_LIST', {})
 TERMS_EXCLUDE_URL_LIST = getattr(settings, 'TERMS_EXCLUDE_URL_LIST', {'/', '/termsrequired/', '/logout/', '/securetoo/'})
+TERMS_PATH_MEMO_SIZE = getattr(settings, 'TERMS_PATH_MEMO_SIZE', 1024)
 
 
-class TermsAndConditionsRedirectMiddleware(MiddlewareMixin):
+class TermsAndConditionsRedirectMiddleware(AsyncRedirectMiddlewareMixin, MiddlewareMixin):
     """
     This middleware checks to see if the user is logged in, and if so,
     if they have accepted all the active terms.
+
+    On Django 3.1+ it is both sync and async capable.
     """
 
     def process_request(self, request):
@@ -37,14 +50,75 @@ class TermsAndConditionsRedirectMiddleware(MiddlewareMixin):
             user_authenticated = request.user.is_authenticated
 
         if user_authenticated and is_path_protected(current_path):
-            for term in TermsAndConditions.get_active_terms_not_agreed_to(request.user):
+            active_terms_ids = None
+            if get_acceptance_token_mode():
+                active_terms_ids = TermsAndConditions.get_active_terms_ids()
+                if has_acceptance_token(request, active_terms_ids):
+                    return None
+
+            for term in get_not_agreed_terms(request):
                 # Check for querystring and include it if there is one
                 qs = request.META['QUERY_STRING']
                 current_path += '?' + qs if qs else ''
+                metrics.redirect('middleware')
                 return redirect_to_terms_accept(current_path, term.slug)
 
+            if active_terms_ids is not None:
+                set_acceptance_token(request, request.user, active_terms_ids)
+
         return None
 
+    def process_response(self, request, response):
+        """Writes any acceptance token cookie set while processing the request"""
+        return save_acceptance_token(request, response)
+
+
+class PathMatcher(object):
+    """
+    Decides whether paths are protected, using exclusion lists compiled once into regular expressions.
+
+    All prefixes are folded into one anchored pattern and all fragments into one search pattern, so a path is
+    checked in a single pass per list. Answers for up to memo_size recent paths are remembered.
+    """
+
+    def __init__(self, prefixes=(), contains=(), exact=(), memo_size=0):
+        self.prefix_pattern = self._compile(prefixes)
+        self.contains_pattern = self._compile(contains)
+        self.exact = frozenset(exact)
+        self.memo_size = memo_size
+        self.memo = {}
+
+    @staticmethod
+    def _compile(fragments):
+        """Returns one pattern matching any of the given literal fragments, or None if there are none"""
+        fragments = sorted(set(fragments))
+        if not fragments:
+            return None
+        return re.compile('|'.join(re.escape(fragment) for fragment in fragments))
+
+    def is_path_protected(self, path):
+        """returns True if given path is to be protected, otherwise False"""
+        protected = self.memo.get(path)
+        if protected is None:
+            protected = not (
+                path in self.exact or
+                (self.prefix_pattern is not None and self.prefix_pattern.match(path)) or
+                (self.contains_pattern is not None and self.contains_pattern.search(path))
+            )
+            if self.memo_size:
+                if len(self.memo) >= self.memo_size:
+                    self.memo.clear()
+                self.memo[path] = protected
+        return protected
+
+
+PATH_MATCHER = PathMatcher(
+    prefixes=list(TERMS_EXCLUDE_URL_PREFIX_LIST) + [ACCEPT_TERMS_PATH],
+    contains=TERMS_EXCLUDE_URL_CONTAINS_LIST,
+    exact=TERMS_EXCLUDE_URL_LIST,
+    memo_size=TERMS_PATH_MEMO_SIZE,
+)
+
 
 def is_path_protected(path):
     """
@@ -54,21 +128,4 @@ def is_path_protected(path):
     TERMS_EXCLUDE_URL_PREFIX_LIST, TERMS_EXCLUDE_URL_LIST, TERMS_EXCLUDE_URL_CONTAINS_LIST or as
     ACCEPT_TERMS_PATH
     """
-    protected = True
-
-    for exclude_path in TERMS_EXCLUDE_URL_PREFIX_LIST:
-        if path.startswith(exclude_path):
-            protected = False
-
-    for contains_path in TERMS_EXCLUDE_URL_CONTAINS_LIST:
-        if contains_path in path:
-            protected = False
-
-    if path in TERMS_EXCLUDE_URL_LIST:
-        protected = False
-
-    if path.startswith(ACCEPT_TERMS_PATH):
-        protected = False
-
-
-    return protected
+    return PATH_MATCHER.is_path_protected(path)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.15 on 2026-10-16 14:15
+from __future__ import unicode_literals
+
+from django import VERSION as DJANGO_VERSION
+from django.db import migrations, models
+
+if DJANGO_VERSION >= (1, 11):
+    index_operations = [
+        migrations.AddIndex(
+            model_name='termsandconditions',
+            index=models.Index(fields=['slug', 'date_active'], name='tandc_slug_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='termsandconditions',
+            index=models.Index(fields=['date_active', 'slug'], name='tandc_active_slug_idx'),
+        ),
+    ]
+else:  # pragma: nocover
+    index_operations = [
+        migrations.AlterIndexTogether(
+            name='termsandconditions',
+            index_together={('slug', 'date_active'), ('date_active', 'slug')},
+        ),
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('termsandconditions', '0003_auto_20170627_1217'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='usertermsandconditions',
+            name='date_accepted',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Date Accepted'),
+        ),
+    ] + index_operations
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.1.15 on 2026-10-16 14:28
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('termsandconditions', '0004_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TermsEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient', models.EmailField(max_length=254, verbose_name='Recipient')),
+                ('from_email', models.CharField(max_length=255, verbose_name='From')),
+                ('subject', models.TextField(verbose_name='Subject')),
+                ('body', models.TextField(verbose_name='Body')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], db_index=True, default='pending', max_length=10, verbose_name='Status')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Attempts')),
+                ('error', models.TextField(blank=True, default='', verbose_name='Last Error')),
+                ('date_created', models.DateTimeField(auto_now_add=True, verbose_name='Date Created')),
+                ('date_sent', models.DateTimeField(blank=True, null=True, verbose_name='Date Sent')),
+                ('terms', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='emails', to='termsandconditions.TermsAndConditions')),
+            ],
+            options={
+                'verbose_name': 'Terms Email',
+                'verbose_name_plural': 'Terms Emails',
+                'get_latest_by': 'date_created',
+            },
+        ),
+    ]
@@ -2,8 +2,10 @@
 
 # pylint: disable=C1001,E0202,W0613
 from collections import OrderedDict
+import math
+import time
 
-from django.db import models
+from django.db import connections, models, transaction, IntegrityError
 from django.conf import settings
 from django import VERSION as DJANGO_VERSION
 
@@ -15,21 +17,50 @@ from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.core.cache import cache
 
+from . import acceptance_index, metrics
+from .caching import (
+    TERMS_GENERATION_CACHE_KEY, after_commit, get_or_recompute, get_terms_generation, local_snapshot,
+    not_agreed_terms_cache_key, prefetch, terms_version_cache_key,
+)
+
 import logging
 
 LOGGER = logging.getLogger(name='termsandconditions')
 
 DEFAULT_TERMS_SLUG = getattr(settings, 'DEFAULT_TERMS_SLUG', 'site-terms')
 TERMS_CACHE_SECONDS = getattr(settings, 'TERMS_CACHE_SECONDS', 30)
+TERMS_ACTIVE_CACHE_SECONDS = getattr(settings, 'TERMS_ACTIVE_CACHE_SECONDS', TERMS_CACHE_SECONDS)
 TERMS_EXCLUDE_USERS_WITH_PERM = getattr(settings, 'TERMS_EXCLUDE_USERS_WITH_PERM', None)
 
+# When each slug without active terms was last logged in this process
+_missing_terms_logged = {}
+
+
+def _bulk_create_ignore_conflicts(model, objs):
+    """Inserts objs in one batch, leaving out rows that already exist"""
+    if DJANGO_VERSION >= (2, 2):
+        model.objects.bulk_create(objs, ignore_conflicts=True)
+        return
+
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(objs)
+    except IntegrityError:
+        # Some rows were inserted concurrently, insert the rest one at a time
+        for obj in objs:
+            try:
+                with transaction.atomic():
+                    obj.save(force_insert=True)
+            except IntegrityError:
+                pass
+
 
 class UserTermsAndConditions(models.Model):
     """Holds mapping between TermsAndConditions and Users"""
     user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="userterms", on_delete=models.CASCADE)
     terms = models.ForeignKey("TermsAndConditions", related_name="userterms", on_delete=models.CASCADE)
     ip_address = models.GenericIPAddressField(null=True, blank=True, verbose_name=_('IP Address'))
-    date_accepted = models.DateTimeField(auto_now_add=True, verbose_name=_('Date Accepted'))
+    date_accepted = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name=_('Date Accepted'))
 
     class Meta:
         """Model Meta Information"""
@@ -41,6 +72,25 @@ class UserTermsAndConditions(models.Model):
     def __str__(self):  # pragma: nocover
         return "{0}:{1}-{2:.2f}".format(self.user.get_username(), self.terms.slug, self.terms.version_number)
 
+    @staticmethod
+    def accept_terms(user, terms_ids, ip_address=None):
+        """Records a user's acceptance of several terms at once, returns the ids of the newly accepted terms"""
+
+        new_terms_ids = list(TermsAndConditions.objects.filter(pk__in=terms_ids).exclude(
+            userterms__user=user
+        ).values_list('pk', flat=True))
+
+        if new_terms_ids:
+            _bulk_create_ignore_conflicts(UserTermsAndConditions, [
+                UserTermsAndConditions(user=user, terms_id=terms_id, ip_address=ip_address)
+                for terms_id in new_terms_ids
+            ])
+            # Bulk inserts send no post_save signals, so clear the user's cached entry here, once
+            cache.delete(not_agreed_terms_cache_key(user.pk))
+            after_commit(acceptance_index.mark_accepted, user.pk, new_terms_ids)
+
+        return new_terms_ids
+
 
 class TermsAndConditions(models.Model):
     """Holds Versions of TermsAndConditions
@@ -62,6 +112,14 @@ class TermsAndConditions(models.Model):
         get_latest_by = 'date_active'
         verbose_name = 'Terms and Conditions'
         verbose_name_plural = 'Terms and Conditions'
+        # Latest active version of one slug, and the active versions of all slugs
+        if DJANGO_VERSION >= (1, 11):
+            indexes = [
+                models.Index(fields=['slug', 'date_active'], name='tandc_slug_active_idx'),
+                models.Index(fields=['date_active', 'slug'], name='tandc_active_slug_idx'),
+            ]
+        else:  # pragma: nocover
+            index_together = (('slug', 'date_active'), ('date_active', 'slug'))
 
     def __str__(self):  # pragma: nocover
         return "{0}-{1:.2f}".format(self.slug, self.version_number)
@@ -71,76 +129,281 @@ class TermsAndConditions(models.Model):
             'tc_view_specific_version_page',
             args=[self.slug, self.version_number])  # pylint: disable=E1101
 
+    @staticmethod
+    def get_next_activation(cached=None):
+        """Returns the date the next scheduled terms and conditions become active, or None"""
+
+        if cached is None or 'tandc.next_activation' not in cached or TERMS_GENERATION_CACHE_KEY not in cached:
+            cached = prefetch([TERMS_GENERATION_CACHE_KEY, 'tandc.next_activation'])
+        generation = get_terms_generation(cached)
+
+        # Kept with the generation it was found in, so a lookup racing with a terms change is not served after it
+        entry = cached['tandc.next_activation']
+        if entry is not None and entry[0] == generation:
+            return entry[1] or None
+
+        next_activation = TermsAndConditions.objects.filter(
+            date_active__gt=timezone.now()
+        ).aggregate(models.Min('date_active'))['date_active__min']
+
+        # Cache "nothing scheduled" as False, and anything scheduled only until it goes live
+        timeout = TERMS_ACTIVE_CACHE_SECONDS
+        if next_activation is not None:
+            timeout = min(timeout, TermsAndConditions._seconds_until(next_activation))
+        entry = (generation, next_activation or False)
+        cache.set('tandc.next_activation', entry, timeout)
+        # Later timeouts of the same lookup are then taken from cached, rather than from another aggregate
+        cached['tandc.next_activation'] = entry
+
+        return next_activation
+
+    @staticmethod
+    def _seconds_until(date):
+        """Returns the whole number of seconds from now until date, rounded up, or 0 if it has passed"""
+        return max(0, int(math.ceil((date - timezone.now()).total_seconds())))
+
+    @staticmethod
+    def get_cache_timeout(cache_seconds=TERMS_ACTIVE_CACHE_SECONDS, cached=None):
+        """Returns how long active terms may be cached: at most cache_seconds, and never past the next activation"""
+
+        next_activation = TermsAndConditions.get_next_activation(cached)
+        if next_activation is None:
+            return cache_seconds
+        return min(cache_seconds, TermsAndConditions._seconds_until(next_activation))
+
+    @staticmethod
+    def get_latest_active_versions():
+        """Returns a queryset of the latest active version of each slug, ordered by slug (Django 1.11+)"""
+
+        active_terms = TermsAndConditions.objects.filter(date_active__isnull=False, date_active__lte=timezone.now())
+        if connections[active_terms.db].vendor == 'postgresql':
+            return active_terms.order_by('slug', '-date_active', '-pk').distinct('slug')
+
+        latest_of_slug = active_terms.filter(slug=models.OuterRef('slug')).order_by('-date_active', '-pk')
+        return active_terms.filter(pk=models.Subquery(latest_of_slug.values('pk')[:1])).order_by('slug')
+
     @staticmethod
     def get_active(slug=DEFAULT_TERMS_SLUG):
         """Finds the latest of a particular terms and conditions"""
 
-        active_terms = cache.get('tandc.active_terms_' + slug)
-        if active_terms is None:
-            try:
-                active_terms = TermsAndConditions.objects.filter(
-                    date_active__isnull=False,
-                    date_active__lte=timezone.now(),
-                    slug=slug).latest('date_active')
-                cache.set('tandc.active_terms_' + slug, active_terms, TERMS_CACHE_SECONDS)
-            except TermsAndConditions.DoesNotExist:  # pragma: nocover
-                LOGGER.error("Requested Terms and Conditions that Have Not Been Created.")
-                return None
+        # Slugs without active terms are cached as False, until terms of that slug are saved
+        active_terms = get_or_recompute(
+            'tandc.active_terms_' + slug,
+            lambda: (TermsAndConditions.objects.filter(
+                date_active__isnull=False,
+                date_active__lte=timezone.now(),
+                slug=slug).order_by('-date_active').first() or False, TermsAndConditions.get_cache_timeout()),
+            'get_active')
+
+        if not active_terms:
+            now = time.time()
+            if now - _missing_terms_logged.get(slug, 0) >= getattr(settings, 'TERMS_MISSING_LOG_SECONDS', 300):
+                if len(_missing_terms_logged) >= 1024:
+                    # Slugs come from URLs, do not let made up ones grow this without bound
+                    _missing_terms_logged.clear()
+                _missing_terms_logged[slug] = now
+                LOGGER.error("Requested Terms and Conditions that Have Not Been Created: %s", slug)
+            return None
 
         return active_terms
 
     @staticmethod
-    def get_active_terms_ids():
-        """Returns a list of the IDs of of all terms and conditions"""
-
-        active_terms_ids = cache.get('tandc.active_terms_ids')
-        if active_terms_ids is None:
-            active_terms_dict = {}
-            active_terms_ids = []
+    def get_version(slug, version_number):
+        """Finds a particular version of terms and conditions, or None if there is no such version"""
+
+        cache_key = terms_version_cache_key(slug, version_number)
+        terms = cache.get(cache_key)
+        if terms is None:
+            with metrics.recompute('get_version'):
+                terms = TermsAndConditions.objects.filter(
+                    slug=slug,
+                    version_number=version_number).order_by('-date_active').first()
+                # Keyed by generation, so any terms change invalidates it; cache missing versions as False
+                cache.set(cache_key, terms or False, TERMS_ACTIVE_CACHE_SECONDS)
+        else:
+            metrics.hit('get_version')
+
+        return terms or None
 
-            active_terms_set = TermsAndConditions.objects.filter(date_active__isnull=False, date_active__lte=timezone.now()).order_by('date_active')
-            for active_terms in active_terms_set:
-                active_terms_dict[active_terms.slug] = active_terms.id
+    @staticmethod
+    def get_active_terms_ids(cached=None):
+        """Returns a list of the IDs of of all terms and conditions"""
 
-            active_terms_dict = OrderedDict(sorted(active_terms_dict.items(), key=lambda t: t[0]))
+        generation = None
+        if local_snapshot.is_enabled():
+            generation = get_terms_generation(cached)
+            active_terms_ids = local_snapshot.get('tandc.active_terms_ids', generation)
+            if active_terms_ids is not None:
+                metrics.hit('get_active_terms_ids')
+                return active_terms_ids
 
-            for terms in active_terms_dict:
-                active_terms_ids.append(active_terms_dict[terms])
+        active_terms_ids = get_or_recompute(
+            'tandc.active_terms_ids',
+            lambda: (TermsAndConditions._query_active_terms_ids(), TermsAndConditions.get_cache_timeout(cached=cached)),
+            'get_active_terms_ids',
+            cached)
 
-            cache.set('tandc.active_terms_ids', active_terms_ids, TERMS_CACHE_SECONDS)
+        if generation is not None:
+            local_snapshot.set('tandc.active_terms_ids', active_terms_ids, generation,
+                               TermsAndConditions.get_cache_timeout(cached=cached))
 
         return active_terms_ids
 
     @staticmethod
     def get_active_terms_list():
-        """Returns all the latest active terms and conditions"""
+        """Returns a list of all the latest active terms and conditions, ordered by slug"""
 
-        active_terms_list = cache.get('tandc.active_terms_list')
-        if active_terms_list is None:
-            active_terms_list = TermsAndConditions.objects.filter(id__in=TermsAndConditions.get_active_terms_ids()).order_by('slug')
-            cache.set('tandc.active_terms_list', active_terms_list, TERMS_CACHE_SECONDS)
+        generation = None
+        if local_snapshot.is_enabled():
+            generation = get_terms_generation()
+            active_terms_list = local_snapshot.get('tandc.active_terms_list', generation)
+            if active_terms_list is not None:
+                metrics.hit('get_active_terms_list')
+                return active_terms_list
+
+        active_terms_list = get_or_recompute(
+            'tandc.active_terms_list',
+            lambda: (TermsAndConditions._query_active_terms_list(), TermsAndConditions.get_cache_timeout()),
+            'get_active_terms_list')
+
+        if generation is not None:
+            local_snapshot.set('tandc.active_terms_list', active_terms_list, generation,
+                               TermsAndConditions.get_cache_timeout())
 
         return active_terms_list
 
     @staticmethod
-    def get_active_terms_not_agreed_to(user):
-        """Checks to see if a specified user has agreed to all the latest terms and conditions"""
+    def _query_active_terms_ids():
+        """Returns a list of the ids of the latest active terms and conditions, from the database"""
+
+        if DJANGO_VERSION >= (1, 11):
+            return list(TermsAndConditions.get_latest_active_versions().values_list('pk', flat=True))
+
+        active_terms_dict = {}
+        active_terms_ids = []
+
+        active_terms_set = TermsAndConditions.objects.filter(date_active__isnull=False, date_active__lte=timezone.now()).order_by('date_active')
+        for active_terms in active_terms_set:
+            active_terms_dict[active_terms.slug] = active_terms.id
+
+        active_terms_dict = OrderedDict(sorted(active_terms_dict.items(), key=lambda t: t[0]))
+
+        for terms in active_terms_dict:
+            active_terms_ids.append(active_terms_dict[terms])
+
+        return active_terms_ids
+
+    @staticmethod
+    def _query_active_terms_list():
+        """Returns a list of the latest active terms and conditions, from the database"""
+
+        if DJANGO_VERSION >= (1, 11):
+            active_terms_list = TermsAndConditions.get_latest_active_versions()
+        else:
+            active_terms_list = TermsAndConditions.objects.filter(id__in=TermsAndConditions.get_active_terms_ids()).order_by('slug')
+        # Cache the instances alone, a pickled queryset would carry its query along
+        return list(active_terms_list)
+
+    @staticmethod
+    def get_active_terms_ids_not_agreed_to(user):
+        """Returns a tuple of the ids of the latest terms and conditions a specified user has not agreed to"""
 
         if TERMS_EXCLUDE_USERS_WITH_PERM is not None:
             if user.has_perm(TERMS_EXCLUDE_USERS_WITH_PERM) and not user.is_superuser:
                 # Django's has_perm() returns True if is_superuser, we don't want that
-                return []
+                return ()
+
+        if user.pk is None:
+            return ()
 
-        not_agreed_terms = cache.get('tandc.not_agreed_terms_' + user.get_username())
-        if not_agreed_terms is None:
+        # One round trip for the user's entry and everything needed to check or recompute it
+        not_agreed_terms_key = not_agreed_terms_cache_key(user.pk)
+        cached = prefetch([TERMS_GENERATION_CACHE_KEY, not_agreed_terms_key,
+                           'tandc.active_terms_ids', 'tandc.next_activation'])
+        generation = get_terms_generation(cached)
+
+        entry = cached[not_agreed_terms_key]
+        if entry is None or entry[0] != generation:
             try:
                 LOGGER.debug("Not Agreed Terms")
-                not_agreed_terms = TermsAndConditions.get_active_terms_list().exclude(
-                    userterms__in=UserTermsAndConditions.objects.filter(user=user)
-                ).order_by('slug')
-
-                cache.set('tandc.not_agreed_terms_' + user.get_username(), not_agreed_terms, TERMS_CACHE_SECONDS)
+                with metrics.recompute('get_active_terms_not_agreed_to'):
+                    # Terms the acceptance index shows as accepted need no query, the database checks the others
+                    unconfirmed_terms_ids = acceptance_index.get_unconfirmed_terms_ids(
+                        user.pk, TermsAndConditions.get_active_terms_ids(cached))
+                    if not unconfirmed_terms_ids:
+                        not_agreed_terms = TermsAndConditions.objects.none()
+                    elif DJANGO_VERSION >= (1, 11):
+                        # Anti-join on the (user, terms) unique index, against the cached active terms ids
+                        not_agreed_terms = TermsAndConditions.objects.filter(
+                            pk__in=unconfirmed_terms_ids
+                        ).annotate(agreed=models.Exists(
+                            UserTermsAndConditions.objects.filter(user=user, terms=models.OuterRef('pk'))
+                        )).filter(agreed=False)
+                    else:
+                        not_agreed_terms = TermsAndConditions.objects.filter(
+                            pk__in=unconfirmed_terms_ids
+                        ).exclude(userterms__in=UserTermsAndConditions.objects.filter(user=user))
+                    not_agreed_terms_ids = tuple(not_agreed_terms.order_by('slug').values_list('pk', flat=True))
+
+                    cache.set(not_agreed_terms_key, (generation, not_agreed_terms_ids),
+                              TermsAndConditions.get_cache_timeout(TERMS_CACHE_SECONDS, cached))
             except (TypeError, UserTermsAndConditions.DoesNotExist):
-                return []
+                return ()
+        else:
+            not_agreed_terms_ids = entry[1]
+            metrics.hit('get_active_terms_not_agreed_to')
+
+        return not_agreed_terms_ids
+
+    @staticmethod
+    def get_active_terms_not_agreed_to(user):
+        """Checks to see if a specified user has agreed to all the latest terms and conditions"""
+
+        return TermsAndConditions.get_active_terms_by_ids(TermsAndConditions.get_active_terms_ids_not_agreed_to(user))
 
-        return not_agreed_terms
+    @staticmethod
+    def get_active_terms_by_ids(terms_ids):
+        """Returns a list of the active terms and conditions with the given ids, in the order of the ids"""
+
+        if not terms_ids:
+            return []
+
+        # Hydrate from the shared active terms list, only going to the database if it has moved on since
+        active_terms = dict((terms.pk, terms) for terms in TermsAndConditions.get_active_terms_list())
+        if all(terms_id in active_terms for terms_id in terms_ids):
+            return [active_terms[terms_id] for terms_id in terms_ids]
+        return list(TermsAndConditions.objects.filter(pk__in=terms_ids).order_by('slug'))
+
+
+class TermsEmail(models.Model):
+    """Holds an email of terms and conditions waiting to be delivered, and the outcome of its delivery"""
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, _('Pending')),
+        (SENT, _('Sent')),
+        (FAILED, _('Failed')),
+    )
+
+    terms = models.ForeignKey("TermsAndConditions", related_name="emails", null=True, blank=True,
+                              on_delete=models.SET_NULL)
+    recipient = models.EmailField(verbose_name=_('Recipient'))
+    from_email = models.CharField(max_length=255, verbose_name=_('From'))
+    subject = models.TextField(verbose_name=_('Subject'))
+    body = models.TextField(verbose_name=_('Body'))
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True,
+                              verbose_name=_('Status'))
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name=_('Attempts'))
+    error = models.TextField(blank=True, default='', verbose_name=_('Last Error'))
+    date_created = models.DateTimeField(auto_now_add=True, verbose_name=_('Date Created'))
+    date_sent = models.DateTimeField(null=True, blank=True, verbose_name=_('Date Sent'))
+
+    class Meta:
+        """Model Meta Information"""
+        get_latest_by = 'date_created'
+        verbose_name = _('Terms Email')
+        verbose_name_plural = _('Terms Emails')
+
+    def __str__(self):  # pragma: nocover
+        return "{0}:{1}".format(self.recipient, self.status)
@@ -0,0 +1,135 @@
+"""Email outbox for the termsandconditions module, delivering terms emails outside of the request"""
+
+import logging
+import threading
+from queue import Full, Queue
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import close_old_connections, models, transaction
+from django.utils import timezone
+
+from .models import TermsEmail
+
+LOGGER = logging.getLogger(name='termsandconditions')
+
+
+def get_delivery_mode():
+    """Returns how terms emails are delivered: 'sync', 'thread' or 'outbox'"""
+    return getattr(settings, 'TERMS_EMAIL_DELIVERY', 'sync')
+
+
+def queue_email(subject, body, from_email, recipient, terms=None):
+    """
+    Records an email in the outbox, and hands it to the background workers in 'thread' mode.
+
+    Returns the TermsEmail at once, the delivery outcome is recorded on it later. In 'outbox' mode, or when the
+    workers are busy, it waits for the terms_send_emails command.
+    """
+    email = TermsEmail.objects.create(subject=subject, body=body, from_email=from_email, recipient=recipient,
+                                      terms=terms)
+    if get_delivery_mode() == 'thread':
+        if hasattr(transaction, 'on_commit'):
+            # Workers must not look for the email before the request's transaction is committed
+            transaction.on_commit(lambda: workers.submit(email.pk))
+        else:  # pragma: nocover
+            workers.submit(email.pk)
+    return email
+
+
+def claim(email):
+    """Takes an email for delivery, returns False if another worker has taken it first"""
+    claimed = TermsEmail.objects.filter(pk=email.pk, attempts=email.attempts).exclude(
+        status=TermsEmail.SENT
+    ).update(attempts=models.F('attempts') + 1)
+    if claimed != 1:
+        return False
+    email.attempts += 1
+    return True
+
+
+def _record_failure(email, error):
+    """Records that sending email failed with error"""
+    LOGGER.warning("Sending terms email %s to %s failed: %s", email.pk, email.recipient, error)
+    TermsEmail.objects.filter(pk=email.pk).update(status=TermsEmail.FAILED, error=str(error))
+
+
+def deliver(emails, connection=None):
+    """Sends emails over a single mail connection, recording the outcome of each; returns how many were sent"""
+    connection = connection or get_connection()
+    sent = 0
+    try:
+        connection.open()
+    except Exception as error:  # pylint: disable=W0703
+        # The relay is unreachable, every email counts an attempt and keeps the error for the next run
+        for email in emails:
+            if claim(email):
+                _record_failure(email, error)
+        return sent
+
+    try:
+        for email in emails:
+            if not claim(email):
+                continue
+            message = EmailMessage(email.subject, email.body, email.from_email, [email.recipient],
+                                   connection=connection)
+            try:
+                message.send()
+            except Exception as error:  # pylint: disable=W0703
+                _record_failure(email, error)
+            else:
+                TermsEmail.objects.filter(pk=email.pk).update(status=TermsEmail.SENT, error='',
+                                                              date_sent=timezone.now())
+                sent += 1
+    finally:
+        connection.close()
+    return sent
+
+
+class EmailWorkers(object):
+    """
+    A bounded pool of daemon threads delivering outbox emails.
+
+    Threads are started with the first email. At most TERMS_EMAIL_QUEUE_SIZE emails wait for a thread, further ones
+    are left pending for the terms_send_emails command rather than holding up the request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = None
+
+    def submit(self, email_id):
+        """Queues an email for delivery, returns False if the queue is full"""
+        with self._lock:
+            if self._queue is None:
+                self._queue = Queue(getattr(settings, 'TERMS_EMAIL_QUEUE_SIZE', 100))
+                for number in range(getattr(settings, 'TERMS_EMAIL_WORKERS', 2)):
+                    thread = threading.Thread(target=self._work, name='terms-email-{0}'.format(number))
+                    thread.daemon = True
+                    thread.start()
+        try:
+            self._queue.put_nowait(email_id)
+        except Full:
+            LOGGER.warning("Terms email queue is full, leaving email %s to the outbox", email_id)
+            return False
+        return True
+
+    def join(self):
+        """Waits until every queued email has been handled"""
+        if self._queue is not None:
+            self._queue.join()
+
+    def _work(self):
+        """Delivers queued emails one at a time, for as long as the process runs"""
+        while True:
+            email_id = self._queue.get()
+            try:
+                deliver(TermsEmail.objects.filter(pk=email_id, status=TermsEmail.PENDING))
+            except Exception:  # pylint: disable=W0703
+                LOGGER.exception("Delivering terms email %s failed", email_id)
+            finally:
+                close_old_connections()
+                self._queue.task_done()
+
+
+workers = EmailWorkers()
@@ -3,8 +3,14 @@
 # pylint: disable=C1001,E0202,W0613
 
 import logging
+from django.conf import settings
 from django.core.cache import cache
 from django.dispatch import receiver
+from django.template import TemplateSyntaxError
+from . import acceptance_index
+from .caching import (
+    after_commit, bump_terms_generation, compiled_templates, local_snapshot, not_agreed_terms_cache_key,
+)
 from .models import TermsAndConditions, UserTermsAndConditions
 from django.db.models.signals import post_delete, post_save
 
@@ -15,17 +21,46 @@ LOGGER = logging.getLogger(name='termsandconditions')
 def user_terms_updated(sender, **kwargs):
     """Called when user terms and conditions is changed - to force cache clearing"""
     LOGGER.debug("User T&C Updated Signal Handler")
-    if kwargs.get('instance').user:
-        cache.delete('tandc.not_agreed_terms_' + kwargs.get('instance').user.get_username())
+    instance = kwargs.get('instance')
+    if instance.user_id:
+        cache.delete(not_agreed_terms_cache_key(instance.user_id))
+        if kwargs.get('created'):
+            after_commit(acceptance_index.mark_accepted, instance.user_id, [instance.terms_id])
+        elif kwargs.get('signal') is post_delete:
+            after_commit(acceptance_index.forget_accepted, instance.user_id, [instance.terms_id])
+        elif acceptance_index.get_index_cache() is not None:
+            # The terms accepted before an edit are not known, drop the user's bitmaps for all of them
+            after_commit(acceptance_index.forget_accepted, instance.user_id,
+                         list(TermsAndConditions.objects.values_list('pk', flat=True)))
 
 
 @receiver([post_delete, post_save], sender=TermsAndConditions)
 def terms_updated(sender, **kwargs):
     """Called when terms and conditions is changed - to force cache clearing"""
     LOGGER.debug("T&C Updated Signal Handler")
+    invalidate_terms(kwargs.get('instance').slug)
+    # Lookups made before the change is committed still see the old terms, so invalidate them again afterwards
+    after_commit(invalidate_terms, kwargs.get('instance').slug)
+
+
+def invalidate_terms(slug):
+    """Clears the cached active terms, and starts a new generation"""
     cache.delete('tandc.active_terms_ids')
     cache.delete('tandc.active_terms_list')
-    if kwargs.get('instance').slug:
-        cache.delete('tandc.active_terms_' + kwargs.get('instance').slug)
-    for utandc in UserTermsAndConditions.objects.all():
-        cache.delete('tandc.not_agreed_terms_' + utandc.user.get_username())
+    cache.delete('tandc.next_activation')
+    if slug:
+        cache.delete('tandc.active_terms_' + slug)
+    # Cached terms entries carry their generation, so moving on to a new one invalidates all of them at once
+    bump_terms_generation()
+    local_snapshot.clear()
+
+
+@receiver(post_save, sender=TermsAndConditions)
+def terms_saved(sender, **kwargs):
+    """Called when terms and conditions are saved - to compile their text ahead of the first render"""
+    if getattr(settings, 'TERMS_TEMPLATE_WARM_ON_SAVE', False) and kwargs.get('instance').text:
+        try:
+            compiled_templates.get(kwargs.get('instance').text)
+        except TemplateSyntaxError:
+            # The text is reported when rendered, saving it must not fail
+            LOGGER.warning("Could not compile the text of T&C %s", kwargs.get('instance').pk)
@@ -1,6 +1,7 @@
 """Django Tags"""
 from django import template
-from ..models import TermsAndConditions
+from ..caching import compiled_templates
+from ..memo import get_not_agreed_terms
 from ..middleware import is_path_protected
 from django.conf import settings
 from future.moves.urllib.parse import urlparse
@@ -22,7 +23,7 @@ def show_terms_if_not_agreed(context, field=TERMS_HTTP_PATH_FIELD):
     """
     request = context['request']
     url = urlparse(request.META[field])
-    not_agreed_terms = TermsAndConditions.get_active_terms_not_agreed_to(request.user)
+    not_agreed_terms = get_not_agreed_terms(request)
 
     if not_agreed_terms and is_path_protected(url.path):
         return {'not_agreed_terms': not_agreed_terms, 'returnTo': url.path}
@@ -46,5 +47,7 @@ def as_template(obj):
     ...
         {% include your_variable|as_template %}
     ...
+
+    Compiled templates are cached per process by content, so a given text is only parsed once.
     """
-    return template.Template(obj)
+    return compiled_templates.get(obj)
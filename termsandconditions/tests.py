@@ -1,25 +1,68 @@
 """Unit Tests for the termsandconditions module"""
 
 # pylint: disable=R0904, C0103
+import datetime
 from importlib import import_module
+import json
+import os
+import shutil
+import tempfile
+import time
 import logging
+from smtplib import SMTPException
 
+from django import VERSION as DJANGO_VERSION
 from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
 from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction, IntegrityError
 from django.http import HttpResponseRedirect
 from django.conf import settings
-from django.test import TestCase, RequestFactory
+from django.test import TestCase, TransactionTestCase, RequestFactory
 from django.contrib.auth.models import User, ContentType, Permission
 from django.template import Context, Template
-
-from .models import TermsAndConditions, UserTermsAndConditions, DEFAULT_TERMS_SLUG
+from django.utils import timezone
+from django.utils.http import http_date
+try:
+    from django.utils.six import StringIO
+except ImportError:
+    # Django 3.0+ runs on Python 3 alone
+    from io import StringIO
+
+from . import acceptance_index, metrics
+from .caching import compiled_templates, get_or_recompute, get_terms_generation, not_agreed_terms_cache_key
+from .models import TermsAndConditions, TermsEmail, UserTermsAndConditions, DEFAULT_TERMS_SLUG
+from .memo import get_not_agreed_terms, get_not_agreed_terms_ids
+from .middleware import PathMatcher, is_path_protected
+from .outbox import queue_email, workers
 from .pipeline import user_accept_terms
-from .templatetags.terms_tags import show_terms_if_not_agreed
+from .views import AcceptTermsView
+from .templatetags.terms_tags import as_template, show_terms_if_not_agreed
+
+if DJANGO_VERSION >= (3, 1):
+    # Kept apart, as Python 2 cannot parse async functions
+    from .async_tests import TermsAndConditionsAsyncTestCase  # pylint: disable=W0611
 
 
 LOGGER = logging.getLogger(name='termsandconditions')
 
 
+class FailingEmailBackend(EmailBackend):
+    """Email backend failing like an unreachable relay"""
+
+    def send_messages(self, messages):
+        raise SMTPException('relay down')
+
+
+class UnreachableEmailBackend(EmailBackend):
+    """Email backend failing to connect, like an unreachable relay"""
+
+    def open(self):
+        raise SMTPException('connection refused')
+
+
 class TermsAndConditionsTests(TestCase):
     """Tests Terms and Conditions Module"""
 
@@ -81,6 +124,23 @@ class TermsAndConditionsTests(TestCase):
         self.assertEqual(2, len(active_list))
         self.assertQuerysetEqual(active_list, [repr(self.terms3), repr(self.terms2)])
 
+    def test_not_agreed_terms_cache_entry(self):
+        """Test the per-user cache entry holds only terms ids, and that hits are hydrated without the database"""
+        # The user's and their groups' permissions, the active terms ids, the next activation only once, and the terms
+        with self.assertNumQueries(5):
+            self.assertEqual((3, 2), TermsAndConditions.get_active_terms_ids_not_agreed_to(self.user1))
+        self.assertEqual((3, 2), cache.get(not_agreed_terms_cache_key(self.user1.pk))[1])
+
+        TermsAndConditions.get_active_terms_list()
+        with self.assertNumQueries(0):
+            active_list = TermsAndConditions.get_active_terms_not_agreed_to(self.user1)
+        self.assertEqual([self.terms3, self.terms2], active_list)
+
+        UserTermsAndConditions.accept_terms(self.user1, [2, 3])
+        with self.assertNumQueries(1):
+            self.assertEqual([], TermsAndConditions.get_active_terms_not_agreed_to(self.user1))
+        self.assertEqual((), cache.get(not_agreed_terms_cache_key(self.user1.pk))[1])
+
     def test_user_is_excluded(self):
         """Test user3 has perm which excludes them from having to accept T&Cs"""
         active_list = TermsAndConditions.get_active_terms_not_agreed_to(self.user3)
@@ -99,12 +159,163 @@ class TermsAndConditionsTests(TestCase):
         self.assertEqual(2, len(active_list))
         self.assertQuerysetEqual(active_list, [repr(self.terms3), repr(self.terms2)])
 
+    def _explain_query_plan(self, queryset):
+        """Returns SQLite's query plan for a queryset as one string"""
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' '.join(str(row[-1]) for row in cursor.fetchall())
+
+    def test_active_terms_query_uses_index(self):
+        """Test the active terms lookups are answered from the (slug, date_active) indexes on SQLite"""
+        if connection.vendor != 'sqlite':  # pragma: nocover
+            self.skipTest('Query plan check is written for SQLite')
+
+        latest_plan = self._explain_query_plan(TermsAndConditions.objects.filter(
+            date_active__isnull=False, date_active__lte="2018-01-01", slug='site-terms').order_by('-date_active')[:1])
+        self.assertIn('tandc_slug_active_idx', latest_plan)
+        self.assertIn('slug=?', latest_plan)
+
+        active_plan = self._explain_query_plan(TermsAndConditions.objects.filter(
+            date_active__isnull=False, date_active__lte="2018-01-01").values_list('slug', 'pk'))
+        self.assertIn('COVERING INDEX', active_plan)
+        self.assertIn('tandc_active_slug_idx', active_plan)
+
+    def test_cache_timeout_follows_next_activation(self):
+        """Test active terms are cached no longer than until the next scheduled version goes live"""
+        self.assertEqual(self.terms4.date_active, str(TermsAndConditions.get_next_activation().date()))
+        self.assertEqual(3600, TermsAndConditions.get_cache_timeout(3600))
+
+        soon = timezone.now() + datetime.timedelta(seconds=90)
+        TermsAndConditions.objects.create(id=5, slug="site-terms", name="Site Terms", text="Site Terms and Conditions 3",
+                                          version_number=3.0, date_active=soon)
+        self.assertEqual(soon, TermsAndConditions.get_next_activation())
+        self.assertTrue(0 < TermsAndConditions.get_cache_timeout(3600) <= 90)
+        self.assertEqual(30, TermsAndConditions.get_cache_timeout(30))
+
+        TermsAndConditions.objects.filter(pk=5).update(date_active=timezone.now() - datetime.timedelta(seconds=1))
+        cache.delete('tandc.next_activation')
+        self.assertEqual(3600, TermsAndConditions.get_cache_timeout(3600))
+
+    def test_active_terms_single_query(self):
+        """Test the latest active version of every slug is found in one query, however many versions exist"""
+        TermsAndConditions.objects.create(id=5, slug="site-terms", name="Site Terms", text="Site Terms and Conditions 0",
+                                          version_number=0.5, date_active="2011-06-01")
+        TermsAndConditions.get_next_activation()
+
+        cache.delete('tandc.active_terms_ids')
+        with self.assertNumQueries(1):
+            self.assertEqual([3, 2], TermsAndConditions.get_active_terms_ids())
+
+        cache.delete('tandc.active_terms_list')
+        with self.assertNumQueries(1):
+            self.assertEqual([self.terms3, self.terms2], list(TermsAndConditions.get_active_terms_list()))
+
+        self.assertEqual((3, 2), TermsAndConditions.get_active_terms_ids_not_agreed_to(self.user1))
+        UserTermsAndConditions.objects.create(user=self.user1, terms=self.terms3)
+        with self.assertNumQueries(1):
+            self.assertEqual((2,), TermsAndConditions.get_active_terms_ids_not_agreed_to(self.user1))
+
+    def test_missing_slug_cached(self):
+        """Test slugs without active terms are cached, logged once, and picked up once terms are created"""
+        with self.assertLogs('termsandconditions', 'ERROR') as logs:
+            self.assertIsNone(TermsAndConditions.get_active('missing-terms'))
+            with self.assertNumQueries(0):
+                self.assertIsNone(TermsAndConditions.get_active('missing-terms'))
+            cache.delete('tandc.active_terms_missing-terms')
+            self.assertIsNone(TermsAndConditions.get_active('missing-terms'))
+        self.assertEqual(1, len(logs.output))
+        self.assertIn('missing-terms', logs.output[0])
+
+        terms = TermsAndConditions.objects.create(slug='missing-terms', name='Found Terms', version_number=1.0,
+                                                  date_active='2012-01-01')
+        self.assertEqual(terms, TermsAndConditions.get_active('missing-terms'))
+        with self.assertLogs('termsandconditions', 'ERROR'):
+            self.assertEqual(404, self.client.get('/terms/view/other-missing-terms/').status_code)
+
+    def test_single_flight_refresh(self):
+        """Test only the worker holding the refresh lock recomputes, while the others serve the previous value"""
+        TermsAndConditions.get_next_activation()
+        stale_entry = ([1, 2], time.time() - 1, 0.01, get_terms_generation())
+
+        cache.set('tandc.active_terms_ids', stale_entry)
+        cache.add('tandc.active_terms_ids.lock', True)
+        with self.assertNumQueries(0):
+            self.assertEqual([1, 2], TermsAndConditions.get_active_terms_ids())
+
+        cache.delete('tandc.active_terms_ids.lock')
+        with self.assertNumQueries(1):
+            self.assertEqual([3, 2], TermsAndConditions.get_active_terms_ids())
+        self.assertIsNone(cache.get('tandc.active_terms_ids.lock'))
+        with self.assertNumQueries(0):
+            self.assertEqual([3, 2], TermsAndConditions.get_active_terms_ids())
+
+        # Nothing to serve and the lock taken: wait for the other worker, then recompute
+        cache.delete('tandc.active_terms_ids')
+        cache.add('tandc.active_terms_ids.lock', True)
+        with self.settings(TERMS_REFRESH_WAIT_SECONDS=0.1), self.assertNumQueries(1):
+            self.assertEqual([3, 2], TermsAndConditions.get_active_terms_ids())
+        cache.delete('tandc.active_terms_ids.lock')
+
+        # Entries which took long to compute are refreshed before they expire
+        cache.set('tandc.active_terms_ids', ([1, 2], time.time() + 5, 5.0, get_terms_generation()))
+        with self.settings(TERMS_EARLY_REFRESH_BETA=0), self.assertNumQueries(0):
+            self.assertEqual([1, 2], TermsAndConditions.get_active_terms_ids())
+        with self.settings(TERMS_EARLY_REFRESH_BETA=1000), self.assertNumQueries(1):
+            self.assertEqual([3, 2], TermsAndConditions.get_active_terms_ids())
+
+    def test_recompute_racing_terms_change(self):
+        """Test active terms computed before a terms change are not served after it, even if cached after it"""
+        TermsAndConditions.get_next_activation()
+        cache.delete('tandc.active_terms_ids')
+
+        def recompute_during_change():
+            """Reads the active terms ids, then lets other terms be saved before they are cached"""
+            active_terms_ids = TermsAndConditions._query_active_terms_ids()
+            TermsAndConditions.objects.create(id=5, slug="new-terms", name="New Terms", version_number=1.0,
+                                              date_active="2012-01-01")
+            return active_terms_ids, 3600
+
+        self.assertEqual([3, 2], get_or_recompute('tandc.active_terms_ids', recompute_during_change,
+                                                  'get_active_terms_ids'))
+        self.assertEqual([3, 5, 2], TermsAndConditions.get_active_terms_ids())
+
     def test_get_active_terms_ids(self):
         """Test get ids of active T&Cs"""
         active_list = TermsAndConditions.get_active_terms_ids()
         self.assertEqual(2, len(active_list))
         self.assertEqual(active_list, [3, 2])
 
+    def test_terms_update_does_not_scan_acceptances(self):
+        """Test changing terms invalidates per-user cache entries without querying acceptances"""
+        UserTermsAndConditions.objects.create(user=self.user1, terms=self.terms2)
+        UserTermsAndConditions.objects.create(user=self.user1, terms=self.terms3)
+        self.assertEqual(0, len(TermsAndConditions.get_active_terms_not_agreed_to(self.user1)))
+
+        self.terms4.date_active = "2012-02-01"
+        with self.assertNumQueries(1):
+            self.terms4.save()
+
+        active_list = TermsAndConditions.get_active_terms_not_agreed_to(self.user1)
+        self.assertQuerysetEqual(active_list, [repr(self.terms4)])
+
+    def test_local_snapshot(self):
+        """Test the per-process snapshot serves active terms without the shared cache and follows terms changes"""
+        with self.settings(TERMS_LOCAL_CACHE_SECONDS=60):
+            self.assertEqual([3, 2], TermsAndConditions.get_active_terms_ids())
+            self.assertEqual(2, len(TermsAndConditions.get_active_terms_list()))
+
+            cache.delete('tandc.active_terms_ids')
+            cache.delete('tandc.active_terms_list')
+            with self.assertNumQueries(0):
+                self.assertEqual([3, 2], TermsAndConditions.get_active_terms_ids())
+                self.assertEqual(2, len(TermsAndConditions.get_active_terms_list()))
+
+            self.terms4.date_active = "2012-02-01"
+            self.terms4.save()
+            self.assertEqual([4, 2], TermsAndConditions.get_active_terms_ids())
+            self.assertQuerysetEqual(TermsAndConditions.get_active_terms_list(), [repr(self.terms4), repr(self.terms2)])
+
     def test_terms_and_conditions_models(self):
         """Various tests of the TermsAndConditions Module"""
 
@@ -184,6 +395,20 @@ class TermsAndConditionsTests(TestCase):
         accept_version_post_response = self.client.post('/terms/accept/', {'terms': 3, 'returnTo': '/secure/'}, follow=True)
         self.assertContains(accept_version_post_response, "Secure")
 
+    def test_accept_several_terms(self):
+        """Test accepting several terms in one post, including already accepted and invalid ones"""
+        UserTermsAndConditions.objects.create(user=self.user1, terms=self.terms2)
+        self.client.login(username='user1', password='user1password')
+        self.assertEqual(1, len(TermsAndConditions.get_active_terms_not_agreed_to(self.user1)))
+
+        response = self.client.post('/terms/accept/', {'terms': [2, 3, 99, 'x'], 'returnTo': '/secure/'}, follow=True)
+        self.assertContains(response, "Secure")
+        self.assertEqual([2, 3], sorted(self.user1.userterms.values_list('terms_id', flat=True)))
+        self.assertEqual(0, len(TermsAndConditions.get_active_terms_not_agreed_to(self.user1)))
+
+        self.assertEqual([], UserTermsAndConditions.accept_terms(self.user1, [2, 3]))
+        self.assertEqual([1], UserTermsAndConditions.accept_terms(self.user1, [1, 2, 3]))
+
     def test_accept_store_ip_address(self):
         """Test with IP address storage setting true (default)"""
         self.client.login(username='user1', password='user1password')
@@ -227,6 +452,36 @@ class TermsAndConditionsTests(TestCase):
         post_upgrade_response = self.client.get('/secure/', follow=True)
         self.assertRedirects(post_upgrade_response, '/terms/accept/site-terms?returnTo=/secure/')
 
+    def _check_acceptance_token(self):
+        """Accepts all terms, then checks requests are let through on the token alone until terms change"""
+        self.client.login(username='user1', password='user1password')
+        accept_response = self.client.post('/terms/accept/', {'terms': [2, 3], 'returnTo': '/secure/'}, follow=True)
+        self.assertContains(accept_response, "Secure")
+
+        # The acceptance records are gone, but the token still names the active terms
+        UserTermsAndConditions.objects.all().delete()
+        self.assertContains(self.client.get('/secure/', follow=True), "Secure")
+
+        TermsAndConditions.objects.create(id=5, slug="site-terms", name="Site Terms", text="Terms and Conditions2",
+                                          version_number=2.5, date_active="2012-02-05")
+        post_upgrade_response = self.client.get('/secure/', follow=True)
+        self.assertRedirects(post_upgrade_response, '/terms/accept/contrib-terms?returnTo=/secure/')
+
+    def test_acceptance_token_in_session(self):
+        """Test the middleware skips the acceptance lookup for a user with a session token"""
+        with self.settings(TERMS_ACCEPTANCE_TOKEN='session'):
+            self._check_acceptance_token()
+            self.assertIn('tandc_accepted', self.client.session)
+
+    def test_acceptance_token_in_cookie(self):
+        """Test the middleware skips the acceptance lookup for a user with a signed cookie token"""
+        with self.settings(TERMS_ACCEPTANCE_TOKEN='cookie'):
+            self._check_acceptance_token()
+            self.assertIn('tandc_accepted', self.client.cookies)
+
+            self.client.cookies['tandc_accepted'] = '2:3.2'
+            self.assertRedirects(self.client.get('/secure/', follow=True), '/terms/accept/contrib-terms?returnTo=/secure/')
+
     def test_no_middleware(self):
         """Test a secure page with the middleware excepting it"""
 
@@ -244,6 +499,176 @@ class TermsAndConditionsTests(TestCase):
         admin_response = self.client.get('/admin', follow=True)
         self.assertContains(admin_response, "administration")
 
+    def test_is_path_protected(self):
+        """Test the exclusion lists from the settings are applied to paths"""
+        self.assertTrue(is_path_protected('/secure/'))
+        self.assertTrue(is_path_protected('/secure/terms'))
+        self.assertFalse(is_path_protected('/'))
+        self.assertFalse(is_path_protected('/securetoo/'))
+        self.assertFalse(is_path_protected('/admin/auth/user/'))
+        self.assertFalse(is_path_protected('/terms/accept/site-terms'))
+
+    def test_path_matcher(self):
+        """Test the compiled path matcher answers like a plain scan of the exclusion lists"""
+        prefixes = ['/admin', '/static/tenant-1/', '/a.b', '/health']
+        contains = ['/api/', '[x]']
+        exact = ['/', '/logout/']
+
+        def scan(path):
+            """Reference implementation checking every list entry"""
+            return not (any(path.startswith(prefix) for prefix in prefixes) or
+                        any(fragment in path for fragment in contains) or path in exact)
+
+        paths = ['/', '/logout/', '/logout/x', '/admin', '/administrator/', '/x/admin', '/static/tenant-1/app.js',
+                 '/static/tenant-2/app.js', '/a.b/c', '/axb/c', '/v1/api/users', '/api', '/list[x]', '/healthz', '']
+        for memo_size in (0, 3):
+            matcher = PathMatcher(prefixes, contains, exact, memo_size=memo_size)
+            for path in paths + paths:
+                self.assertEqual(scan(path), matcher.is_path_protected(path), path)
+            self.assertLessEqual(len(matcher.memo), memo_size)
+
+        self.assertTrue(PathMatcher().is_path_protected('/anything/'))
+
+    def test_not_agreed_terms_memo(self):
+        """Test the terms a user has not agreed to are looked up once per request, and forgotten on acceptance"""
+        collector = metrics.get_collector()
+        collector.reset()
+        request = RequestFactory().post('/terms/accept/', {'terms': [2, 3], 'returnTo': '/secure/'})
+        request.user = self.user1
+
+        self.assertEqual((3, 2), get_not_agreed_terms_ids(request))
+        self.assertEqual([self.terms3, self.terms2], get_not_agreed_terms(request))
+        with self.assertNumQueries(0):
+            self.assertEqual([self.terms3, self.terms2], get_not_agreed_terms(request))
+        self.assertEqual(1, sum(count for (name, lookup), count in collector.counters.items()
+                                if lookup == 'get_active_terms_not_agreed_to' and name.startswith('cache_')))
+
+        request.user = self.user2
+        self.assertEqual((3, 2), get_not_agreed_terms_ids(request))
+        request.user = self.user1
+
+        response = AcceptTermsView.as_view()(request)
+        self.assertEqual('/secure/', response['Location'])
+        self.assertEqual((), get_not_agreed_terms_ids(request))
+
+    def test_metrics(self):
+        """Test lookups and redirects are counted and exposed in the text format"""
+        collector = metrics.get_collector()
+        collector.reset()
+
+        TermsAndConditions.get_active_terms_ids_not_agreed_to(self.user1)
+        TermsAndConditions.get_active_terms_ids_not_agreed_to(self.user1)
+        self.assertEqual(1, collector.counters[('cache_misses_total', 'get_active_terms_not_agreed_to')])
+        self.assertEqual(1, collector.counters[('cache_hits_total', 'get_active_terms_not_agreed_to')])
+        self.assertGreater(collector.counters[('recompute_queries_total', 'get_active_terms_not_agreed_to')], 0)
+
+        self.client.login(username='user1', password='user1password')
+        self.client.get('/secure/')
+        self.assertEqual(1, collector.counters[('redirects_total', 'middleware')])
+
+        response = self.client.get('/terms/metrics/')
+        self.assertEqual('text/plain; version=0.0.4; charset=utf-8', response['Content-Type'])
+        self.assertContains(response, 'termsandconditions_redirects_total{source="middleware"} 1')
+        self.assertContains(response, 'termsandconditions_cache_hits_total{lookup="get_active_terms_not_agreed_to"}')
+
+        self.client.logout()
+        self.assertEqual(403, self.client.get('/terms/metrics/', REMOTE_ADDR='10.0.0.1').status_code)
+
+        with self.settings(TERMS_METRICS_COLLECTOR=None):
+            self.assertIsNone(metrics.get_collector())
+            self.assertEqual(404, self.client.get('/terms/metrics/').status_code)
+
+    def test_export_import_acceptances(self):
+        """Test acceptances survive an export and import round trip in both formats, with filters applied"""
+        UserTermsAndConditions.objects.create(user=self.user1, terms=self.terms2, ip_address='10.0.0.1')
+        UserTermsAndConditions.objects.create(user=self.user1, terms=self.terms3)
+        UserTermsAndConditions.objects.create(user=self.user2, terms=self.terms1)
+        UserTermsAndConditions.objects.filter(user=self.user2).update(date_accepted="2015-06-01")
+        self.user2.username = u'us\xe9r2'
+        self.user2.save()
+        exported = sorted(UserTermsAndConditions.objects.values_list('user_id', 'terms_id', 'ip_address', 'date_accepted'))
+
+        directory = tempfile.mkdtemp()
+        try:
+            for file_format in ('csv', 'jsonl'):
+                path = os.path.join(directory, 'acceptances.' + file_format)
+                call_command('terms_export_acceptances', format=file_format, output=path, stderr=StringIO())
+                UserTermsAndConditions.objects.all().delete()
+
+                stderr = StringIO()
+                call_command('terms_import_acceptances', path, batch_size=2, stderr=stderr)
+                self.assertIn('Imported 3 rows', stderr.getvalue())
+                self.assertEqual(exported, sorted(UserTermsAndConditions.objects.values_list(
+                    'user_id', 'terms_id', 'ip_address', 'date_accepted')))
+
+                # Importing again leaves the existing rows alone
+                call_command('terms_import_acceptances', path, stderr=StringIO())
+                self.assertEqual(3, UserTermsAndConditions.objects.count())
+
+            stdout = StringIO()
+            call_command('terms_export_acceptances', format='jsonl', slug=['site-terms'], since='2016-01-01',
+                         stdout=stdout, stderr=StringIO())
+            rows = [json.loads(line) for line in stdout.getvalue().splitlines()]
+            self.assertEqual([('user1', 'site-terms', '2.00', '10.0.0.1')],
+                             [(row['username'], row['slug'], row['version_number'], row['ip_address']) for row in rows])
+
+            UserTermsAndConditions.objects.all().delete()
+            stderr = StringIO()
+            call_command('terms_import_acceptances', os.path.join(directory, 'acceptances.csv'), version_number='1.0',
+                         stderr=stderr)
+            self.assertIn('skipped 2 rows', stderr.getvalue())
+            self.assertEqual([self.terms1.pk], list(UserTermsAndConditions.objects.values_list('terms_id', flat=True)))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_admin_csv_download(self):
+        """Test the admin streams filtered and selected acceptances as CSV"""
+        first = UserTermsAndConditions.objects.create(user=self.user1, terms=self.terms2, ip_address='10.0.0.1')
+        UserTermsAndConditions.objects.create(user=self.user2, terms=self.terms3)
+        self.client.login(username='su', password='superstrong')
+
+        changelist_response = self.client.get('/admin/termsandconditions/usertermsandconditions/')
+        self.assertContains(changelist_response, '/admin/termsandconditions/usertermsandconditions/export/?')
+
+        export_response = self.client.get('/admin/termsandconditions/usertermsandconditions/export/',
+                                           {'terms__id__exact': self.terms2.pk})
+        self.assertTrue(export_response.streaming)
+        self.assertEqual('text/csv; charset=utf-8', export_response['Content-Type'])
+        lines = b''.join(export_response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual('user_id,username,slug,version_number,ip_address,date_accepted', lines[0])
+        self.assertEqual(1, len(lines) - 1)
+        self.assertTrue(lines[1].startswith('{0},user1,site-terms,2.00,10.0.0.1,'.format(self.user1.pk)))
+
+        action_response = self.client.post('/admin/termsandconditions/usertermsandconditions/', {
+            'action': 'download_csv', '_selected_action': [first.pk]})
+        self.assertEqual(2, len(b''.join(action_response.streaming_content).splitlines()))
+
+        self.client.login(username='user1', password='user1password')
+        export_response = self.client.get('/admin/termsandconditions/usertermsandconditions/export/')
+        self.assertEqual(302, export_response.status_code)
+
+    def test_admin_changelists(self):
+        """Test the admin changelists leave out the terms text, and edit acceptances with raw id widgets"""
+        from django.test.utils import CaptureQueriesContext
+        from .admin import EstimatedCountPaginator
+
+        acceptance = UserTermsAndConditions.objects.create(user=self.user1, terms=self.terms2)
+        self.client.login(username='su', password='superstrong')
+
+        for changelist_url in ('/admin/termsandconditions/termsandconditions/',
+                               '/admin/termsandconditions/usertermsandconditions/?date_accepted__gte=2012-01-01'):
+            with CaptureQueriesContext(connection) as captured:
+                self.assertEqual(200, self.client.get(changelist_url).status_code)
+            for query in captured:
+                self.assertNotIn('"termsandconditions_termsandconditions"."text"', query['sql'])
+
+        change_response = self.client.get(
+            '/admin/termsandconditions/usertermsandconditions/{0}/change/'.format(acceptance.pk))
+        self.assertContains(change_response, 'vForeignKeyRawIdAdminField')
+        self.assertNotContains(change_response, '<option value="{0}"'.format(self.user2.pk))
+
+        self.assertEqual(4, EstimatedCountPaginator(TermsAndConditions.objects.all(), 2).count)
+
     def test_terms_view(self):
         """Test Accessing the View Terms and Conditions Functions"""
 
@@ -259,6 +684,41 @@ class TermsAndConditionsTests(TestCase):
         version_response = self.client.get(self.terms3.get_absolute_url(), follow=True)
         self.assertContains(version_response, 'Terms and Conditions')
 
+    def test_terms_view_conditional_get(self):
+        """Test terms pages send validators, answer 304 when unchanged, and cache versions for long"""
+        version_response = self.client.get('/terms/view/site-terms/1.0/')
+        self.assertContains(version_response, 'Site Terms and Conditions 1')
+        self.assertIn('max-age=86400', version_response['Cache-Control'])
+        self.assertIn('private', version_response['Cache-Control'])
+        # Edits to terms are not dated, a Last-Modified could tell clients holding stale terms they are current
+        self.assertFalse(version_response.has_header('Last-Modified'))
+
+        with self.assertNumQueries(0):
+            not_modified = self.client.get('/terms/view/site-terms/1.00/',
+                                           HTTP_IF_NONE_MATCH=version_response['ETag'])
+        self.assertEqual(304, not_modified.status_code)
+        self.assertEqual(b'', not_modified.content)
+        self.assertEqual(version_response['ETag'], not_modified['ETag'])
+
+        print_response = self.client.get('/terms/print/site-terms/1.0/', HTTP_IF_NONE_MATCH=version_response['ETag'])
+        self.assertEqual(200, print_response.status_code)
+        self.assertNotEqual(version_response['ETag'], print_response['ETag'])
+
+        self.terms1.text = 'Site Terms and Conditions 1, corrected'
+        self.terms1.save()
+        changed_response = self.client.get('/terms/view/site-terms/1.0/', HTTP_IF_NONE_MATCH=version_response['ETag'])
+        self.assertContains(changed_response, 'Site Terms and Conditions 1, corrected')
+        dated_response = self.client.get('/terms/view/site-terms/1.0/', HTTP_IF_MODIFIED_SINCE=http_date())
+        self.assertContains(dated_response, 'Site Terms and Conditions 1, corrected')
+
+        with self.settings(TERMS_VIEW_CACHE_PUBLIC=True):
+            active_response = self.client.get('/terms/view/site-terms/')
+        self.assertIn('max-age=60', active_response['Cache-Control'])
+        self.assertIn('public', active_response['Cache-Control'])
+
+        self.assertEqual(404, self.client.get('/terms/view/site-terms/9.0/').status_code)
+        self.assertEqual(404, self.client.get('/terms/view/site-terms/1.2.3/').status_code)
+
     def test_user_pipeline(self):
         """Test the case of a user being partially created via the django-socialauth pipeline"""
 
@@ -304,6 +764,88 @@ class TermsAndConditionsTests(TestCase):
                                                                  'returnTo': '/'}, follow=True)
         self.assertContains(email_fail_response, 'Invalid')
 
+    def test_notify_command(self):
+        """Test terms_notify emails users who have not accepted the active terms, and resumes where it stopped"""
+        UserTermsAndConditions.objects.create(user=self.user1, terms=self.terms2)
+
+        stdout = StringIO()
+        call_command('terms_notify', dry_run=True, stdout=stdout)
+        self.assertIn('2 users have not accepted', stdout.getvalue())
+        self.assertEqual(0, len(mail.outbox))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        state_file = os.path.join(directory, 'notify.json')
+
+        call_command('terms_notify', limit=1, state_file=state_file, rate=1000, stderr=StringIO())
+        self.assertEqual([['su@example.com']], [message.to for message in mail.outbox])
+
+        stderr = StringIO()
+        call_command('terms_notify', state_file=state_file, subject='New terms', stderr=stderr)
+        self.assertIn('Emailed 1 rows', stderr.getvalue())
+        self.assertEqual(['user2@user2.com'], mail.outbox[1].to)
+        self.assertEqual('New terms', mail.outbox[1].subject)
+        self.assertIn('Site Terms and Conditions 2', mail.outbox[1].body)
+        self.assertEqual(mail.outbox[0].body, mail.outbox[1].body)
+
+        call_command('terms_notify', state_file=state_file, stderr=StringIO())
+        self.assertEqual(2, len(mail.outbox))
+
+    def test_notify_command_excluded_users(self):
+        """Test terms_notify leaves out users with the skip permission alone, and checks the setting"""
+        # A permission of the same codename in another app, and one of the same app, do not exclude user2
+        content_type = ContentType.objects.get_for_model(TermsAndConditions)
+        self.user2.user_permissions.add(
+            Permission.objects.create(content_type=content_type, name='Can skip T&Cs', codename='can_skip_t&c'),
+            Permission.objects.get(content_type__app_label='auth', codename='add_user'),
+        )
+
+        stdout = StringIO()
+        call_command('terms_notify', dry_run=True, stdout=stdout)
+        self.assertIn('3 users have not accepted', stdout.getvalue())
+
+        terms_notify = import_module('termsandconditions.management.commands.terms_notify')
+        original_permission = terms_notify.TERMS_EXCLUDE_USERS_WITH_PERM
+        terms_notify.TERMS_EXCLUDE_USERS_WITH_PERM = 'can_skip_t&c'
+        try:
+            with self.assertRaises(CommandError):
+                call_command('terms_notify', dry_run=True, stdout=StringIO())
+        finally:
+            terms_notify.TERMS_EXCLUDE_USERS_WITH_PERM = original_permission
+
+    def test_email_terms_outbox(self):
+        """Test emails are queued in the outbox, and the command delivers them and records failures"""
+        with self.settings(TERMS_EMAIL_DELIVERY='outbox'):
+            email_send_response = self.client.post('/terms/email/',
+                                                   {'email_address': 'foo@foo.com', 'email_subject': 'Terms Email',
+                                                    'terms': 2, 'returnTo': '/'}, follow=True)
+        self.assertContains(email_send_response, 'Sent')
+        self.assertEqual(0, len(mail.outbox))
+        queued = TermsEmail.objects.get()
+        self.assertEqual((TermsEmail.PENDING, 'foo@foo.com', self.terms2), (queued.status, queued.recipient, queued.terms))
+
+        with self.settings(EMAIL_BACKEND='termsandconditions.tests.FailingEmailBackend'):
+            call_command('terms_send_emails', stderr=StringIO())
+        queued.refresh_from_db()
+        self.assertEqual((TermsEmail.FAILED, 1, 'relay down'), (queued.status, queued.attempts, queued.error))
+
+        with self.settings(EMAIL_BACKEND='termsandconditions.tests.UnreachableEmailBackend'):
+            call_command('terms_send_emails', stderr=StringIO())
+        queued.refresh_from_db()
+        self.assertEqual((TermsEmail.FAILED, 2, 'connection refused'), (queued.status, queued.attempts, queued.error))
+
+        stderr = StringIO()
+        call_command('terms_send_emails', stderr=stderr)
+        self.assertIn('Sent 1 rows', stderr.getvalue())
+        queued.refresh_from_db()
+        self.assertEqual((TermsEmail.SENT, 3, ''), (queued.status, queued.attempts, queued.error))
+        self.assertIsNotNone(queued.date_sent)
+        self.assertEqual(['foo@foo.com'], mail.outbox[0].to)
+        self.assertEqual('Terms Email', mail.outbox[0].subject)
+
+        call_command('terms_send_emails', stderr=StringIO())
+        self.assertEqual(1, len(mail.outbox))
+
 
 class TermsAndConditionsTemplateTagsTestCase(TestCase):
     """Tests Tags for T&C"""
@@ -377,3 +919,159 @@ class TermsAndConditionsTemplateTagsTestCase(TestCase):
         terms = TermsAndConditions.get_active()
         rendered = Template(self.template_string_3).render(Context({'terms': terms}))
         self.assertIn(terms.text, rendered)
+
+    def test_as_template_cache(self):
+        """Test as_template parses a text once, drops the least recently used, and warms on save"""
+        compiled_templates.clear()
+        with self.settings(TERMS_TEMPLATE_CACHE_SIZE=2):
+            one = as_template('one {{ 1 }}')
+            two = as_template('two')
+            self.assertIs(one, as_template('one {{ 1 }}'))
+            as_template('three')
+            self.assertIs(one, as_template('one {{ 1 }}'))
+            self.assertIsNot(two, as_template('two'))
+            self.assertEqual('one 1', one.render(Context()))
+
+        with self.settings(TERMS_TEMPLATE_CACHE_SIZE=0):
+            self.assertIsNot(as_template('two'), as_template('two'))
+
+        compiled_templates.clear()
+        with self.settings(TERMS_TEMPLATE_WARM_ON_SAVE=True):
+            TermsAndConditions.objects.create(slug='broken', name='Broken', version_number=1, text='{% if %}')
+            warm = TermsAndConditions.objects.create(slug='warm', name='Warm', version_number=1, text='warm {{ 2 }}')
+            self.assertEqual(1, len(compiled_templates._templates))
+            self.assertIs(as_template(warm.text), as_template('warm {{ 2 }}'))
+        compiled_templates.clear()
+
+
+class TermsAndConditionsThreadsTestCase(TransactionTestCase):
+    """Tests the work done in background threads, which needs the data it reads committed"""
+
+    def test_stale_while_revalidate(self):
+        """Test expired terms are served at once while a background thread refreshes them"""
+        terms = TermsAndConditions.objects.create(slug='site-terms', name='Site Terms', text='Site Terms',
+                                                  version_number=1.0, date_active='2012-01-01')
+        cache.clear()
+        cache.set('tandc.active_terms_site-terms', ('stale terms', time.time() - 1, 0.01, get_terms_generation()))
+
+        with self.settings(TERMS_STALE_WHILE_REVALIDATE_SECONDS=60):
+            with self.assertNumQueries(0):
+                self.assertEqual('stale terms', TermsAndConditions.get_active('site-terms'))
+
+            deadline = time.time() + 5
+            while cache.get('tandc.active_terms_site-terms.lock') and time.time() < deadline:
+                time.sleep(0.01)
+            with self.assertNumQueries(0):
+                self.assertEqual(terms, TermsAndConditions.get_active('site-terms'))
+
+    def test_email_terms_workers(self):
+        """Test the background workers deliver queued emails once committed"""
+        with self.settings(TERMS_EMAIL_DELIVERY='thread'):
+            queued = queue_email('Terms Email', 'Terms', 'from@foo.com', 'foo@foo.com')
+        workers.join()
+        queued.refresh_from_db()
+        self.assertEqual(TermsEmail.SENT, queued.status)
+        self.assertEqual(['foo@foo.com'], mail.outbox[0].to)
+
+
+class TermsAndConditionsIndexTestCase(TransactionTestCase):
+    """Tests the acceptance index, which is only updated once acceptances are committed"""
+
+    def setUp(self):
+        """Setup for each test"""
+        self.user1 = User.objects.create_user('user1', 'user1@user1.com', 'user1password')
+        self.user2 = User.objects.create_user('user2', 'user2@user2.com', 'user2password')
+        self.user3 = User.objects.create_user('user3', 'user3@user3.com', 'user3password')
+        self.terms2 = TermsAndConditions.objects.create(id=2, slug="site-terms", name="Site Terms",
+                                                        text="Site Terms and Conditions 2", version_number=2.0,
+                                                        date_active="2012-01-05")
+        self.terms3 = TermsAndConditions.objects.create(id=3, slug="contrib-terms", name="Contributor Terms",
+                                                        text="Contributor Terms and Conditions 1.5", version_number=1.5,
+                                                        date_active="2012-01-01")
+        cache.clear()
+
+    def test_acceptance_index(self):
+        """Test users shown by the acceptance index to have accepted the active terms are checked without a query"""
+        UserTermsAndConditions.objects.create(user=self.user1, terms=self.terms2)
+        UserTermsAndConditions.objects.create(user=self.user1, terms=self.terms3)
+        UserTermsAndConditions.objects.create(user=self.user2, terms=self.terms2)
+
+        with self.settings(TERMS_ACCEPTANCE_INDEX='default'):
+            self.assertEqual((), TermsAndConditions.get_active_terms_ids_not_agreed_to(self.user1))
+            self.assertEqual((3,), TermsAndConditions.get_active_terms_ids_not_agreed_to(self.user2))
+            cache.clear()
+            call_command('terms_build_acceptance_index', stderr=StringIO())
+            TermsAndConditions.get_active_terms_ids()
+            with self.assertNumQueries(0):
+                self.assertEqual((), TermsAndConditions.get_active_terms_ids_not_agreed_to(self.user1))
+            # Only the terms missing from the index are looked up
+            with self.assertNumQueries(1):
+                self.assertEqual((3,), TermsAndConditions.get_active_terms_ids_not_agreed_to(self.user2))
+
+            UserTermsAndConditions.accept_terms(self.user2, [3])
+            with self.assertNumQueries(0):
+                self.assertEqual((), TermsAndConditions.get_active_terms_ids_not_agreed_to(self.user2))
+
+            # Acceptances rolled back are never indexed
+            try:
+                with transaction.atomic():
+                    UserTermsAndConditions.objects.create(user=self.user3, terms=self.terms2)
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+            self.assertEqual([2], acceptance_index.get_unconfirmed_terms_ids(self.user3.pk, [2]))
+
+            # Withdrawn acceptances drop their bitmap, leaving the check to the database
+            UserTermsAndConditions.objects.filter(user=self.user2, terms=self.terms3).delete()
+            with self.assertNumQueries(1):
+                self.assertEqual((3,), TermsAndConditions.get_active_terms_ids_not_agreed_to(self.user2))
+
+        with self.assertRaises(CommandError):
+            call_command('terms_build_acceptance_index', stderr=StringIO())
+
+    def test_acceptance_index_withdrawal_race(self):
+        """Test a bitmap written back after a withdrawal it read before does not bring the withdrawn bit back"""
+        with self.settings(TERMS_ACCEPTANCE_INDEX='default'):
+            index = acceptance_index.get_index_cache()
+            acceptance_index.mark_accepted(self.user1.pk, [2])
+            self.assertEqual([], acceptance_index.get_unconfirmed_terms_ids(self.user1.pk, [2]))
+
+            def withdraw_after_bitmap_read(keys):
+                """Reads the keys, withdrawing user1's acceptance right after the bitmap is read"""
+                found = get_many(keys)
+                if any(key.startswith('tandc.acceptance_bitmap_') for key in keys):
+                    del index.get_many
+                    acceptance_index.forget_accepted(self.user1.pk, [2])
+                return found
+
+            get_many = index.get_many
+            index.get_many = withdraw_after_bitmap_read
+            try:
+                acceptance_index.mark_accepted(self.user2.pk, [2])
+            finally:
+                index.__dict__.pop('get_many', None)
+
+            self.assertEqual([2], acceptance_index.get_unconfirmed_terms_ids(self.user1.pk, [2]))
+            acceptance_index.mark_accepted(self.user2.pk, [2])
+            self.assertEqual([2], acceptance_index.get_unconfirmed_terms_ids(self.user1.pk, [2]))
+            self.assertEqual([], acceptance_index.get_unconfirmed_terms_ids(self.user2.pk, [2]))
+
+
+class TermsAndConditionsBenchmarkTestCase(TestCase):
+    """Tests the benchmark suite runs, and guards the query counts it reports"""
+
+    def test_run_benchmarks(self):
+        """Run the benchmarks on a tiny data set"""
+        from termsandconditions_demo.run_benchmarks import generate_data, run_benchmarks
+
+        accepted_users, pending_users = generate_data(users=4, slugs=2, versions=2, accepted=0.5)
+        self.assertEqual(2, len(accepted_users))
+        self.assertEqual(2, len(pending_users))
+
+        results = dict(((result['name'], result['scenario']), result)
+                       for result in run_benchmarks(accepted_users, pending_users, iterations=3))
+        self.assertEqual(2, results[('AcceptTermsView.post', 'pending')]['iterations'])
+        for name in ('middleware', 'terms_required', 'show_terms_if_not_agreed'):
+            self.assertEqual(0, results[(name, 'accepted-warm')]['queries_per_call'])
+            self.assertEqual(1, results[(name, 'accepted-warm')]['cache_calls_per_call'])
+            self.assertGreater(results[(name, 'accepted-cold')]['queries_per_call'], 0)
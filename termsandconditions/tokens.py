@@ -0,0 +1,59 @@
+"""
+Acceptance tokens for the termsandconditions module.
+
+When TERMS_ACCEPTANCE_TOKEN is 'session' or 'cookie', a user who has agreed to all active terms is given a small
+marker naming the active terms ids they satisfied. As long as the active terms stay the same, later requests can
+compare the marker with the active terms ids and skip the per-user acceptance lookup.
+"""
+
+from django.conf import settings
+
+TERMS_ACCEPTANCE_TOKEN_NAME = getattr(settings, 'TERMS_ACCEPTANCE_TOKEN_NAME', 'tandc_accepted')
+TERMS_ACCEPTANCE_TOKEN_SALT = 'termsandconditions.tokens'
+
+
+def get_acceptance_token_mode():
+    """Returns 'session', 'cookie' or None, depending on where acceptance tokens are kept"""
+    mode = getattr(settings, 'TERMS_ACCEPTANCE_TOKEN', None)
+    return mode if mode in ('session', 'cookie') else None
+
+
+def make_acceptance_token(user, active_terms_ids):
+    """Returns the marker for a user who has agreed to the given active terms ids"""
+    return '{0}:{1}'.format(user.pk, '.'.join(str(terms_id) for terms_id in active_terms_ids))
+
+
+def has_acceptance_token(request, active_terms_ids):
+    """Returns True if the request carries a marker showing its user agreed to exactly these active terms"""
+    mode = get_acceptance_token_mode()
+    if mode == 'session':
+        session = getattr(request, 'session', None)
+        token = session.get(TERMS_ACCEPTANCE_TOKEN_NAME) if session is not None else None
+    elif mode == 'cookie':
+        token = request.get_signed_cookie(TERMS_ACCEPTANCE_TOKEN_NAME, None, salt=TERMS_ACCEPTANCE_TOKEN_SALT)
+    else:
+        return False
+
+    return token is not None and token == make_acceptance_token(request.user, active_terms_ids)
+
+
+def set_acceptance_token(request, user, active_terms_ids):
+    """Gives the request a marker for its user, cookies are only written by save_acceptance_token"""
+    mode = get_acceptance_token_mode()
+    token = make_acceptance_token(user, active_terms_ids)
+    if mode == 'session' and getattr(request, 'session', None) is not None:
+        if request.session.get(TERMS_ACCEPTANCE_TOKEN_NAME) != token:
+            request.session[TERMS_ACCEPTANCE_TOKEN_NAME] = token
+    elif mode == 'cookie':
+        request.terms_acceptance_token = token
+
+
+def save_acceptance_token(request, response):
+    """Writes a marker set on the request during processing to the response as a signed cookie"""
+    token = getattr(request, 'terms_acceptance_token', None)
+    if token is not None:
+        response.set_signed_cookie(
+            TERMS_ACCEPTANCE_TOKEN_NAME, token, salt=TERMS_ACCEPTANCE_TOKEN_SALT, httponly=True,
+            secure=getattr(settings, 'SESSION_COOKIE_SECURE', False),
+        )
+    return response
@@ -7,7 +7,8 @@
 
 from django.conf.urls import url
 from django.contrib import admin
-from .views import TermsView, AcceptTermsView, EmailTermsView
+from django.views.decorators.cache import never_cache
+from .views import TermsView, AcceptTermsView, EmailTermsView, MetricsView
 from .models import DEFAULT_TERMS_SLUG
 
 admin.autodiscover()
@@ -40,4 +41,7 @@ urlpatterns = (
     # Email Specific Terms Version
     url(r'^email/(?P<slug>[a-zA-Z0-9_.-]+)/(?P<version>[0-9\.]+)/$', EmailTermsView.as_view(), name="tc_specific_version_page"),
 
+    # Metrics
+    url(r'^metrics/$', never_cache(MetricsView.as_view()), name="tc_metrics_page"),
+
 )
@@ -3,22 +3,38 @@
 # pylint: disable=E1120,R0901,R0904
 from django import VERSION as DJANGO_VERSION
 from django.contrib.auth.models import User
-from django.db import IntegrityError
 
+from . import metrics
 from .forms import UserTermsAndConditionsModelForm, EmailTermsForm
+from .memo import forget_not_agreed_terms, get_not_agreed_terms
 from .models import TermsAndConditions, UserTermsAndConditions
+from .outbox import get_delivery_mode, queue_email
+from .tokens import get_acceptance_token_mode, set_acceptance_token, save_acceptance_token
 from django.conf import settings
 from django.contrib import messages
 from django.utils.translation import gettext as _
-from django.http import HttpResponseRedirect
-from django.views.generic import DetailView, CreateView, FormView
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.views.generic import DetailView, CreateView, FormView, View
 from django.template.loader import get_template
 from django.core.mail import send_mail
+from django.utils.cache import patch_cache_control
+from django.utils.encoding import force_bytes
+from django.utils import translation
+from decimal import InvalidOperation
+import hashlib
 import logging
 from smtplib import SMTPException
 
+if DJANGO_VERSION >= (1, 11):
+    from django.utils.cache import get_conditional_response
+else:  # pragma: nocover
+    get_conditional_response = None
+
 LOGGER = logging.getLogger(name='termsandconditions')
 DEFAULT_TERMS_BASE_TEMPLATE = 'base.html'
+DEFAULT_TERMS_VERSION_VIEW_CACHE_SECONDS = 86400
+DEFAULT_TERMS_ACTIVE_VIEW_CACHE_SECONDS = 60
 
 
 class GetTermsViewMixin(object):
@@ -31,12 +47,19 @@ class GetTermsViewMixin(object):
         version = kwargs.get("version")
 
         if slug and version:
-            terms = [TermsAndConditions.objects.filter(slug=slug, version_number=version).latest('date_active')]
+            try:
+                terms = [TermsAndConditions.get_version(slug, version)]
+            except InvalidOperation:
+                terms = [None]
+            if terms[0] is None:
+                raise Http404(_("No such version of the terms and conditions"))
         elif slug:
             terms = [TermsAndConditions.get_active(slug)]
+            if terms[0] is None:
+                raise Http404(_("No active terms and conditions"))
         else:
             # Return a list of not agreed to terms for the current user for the list view
-            terms = TermsAndConditions.get_active_terms_not_agreed_to(self.request.user)
+            terms = get_not_agreed_terms(self.request)
         return terms
 
 
@@ -60,6 +83,49 @@ class TermsView(DetailView, GetTermsViewMixin):
         LOGGER.debug('termsandconditions.views.TermsView.get_object')
         return self.get_terms(self.kwargs)
 
+    def get(self, request, *args, **kwargs):
+        """
+        Renders the terms, or answers 304 Not Modified when the client already has them.
+
+        A specific version never changes, so it may be cached for TERMS_VERSION_VIEW_CACHE_SECONDS; the active terms
+        only for TERMS_ACTIVE_VIEW_CACHE_SECONDS, and never past the next activation.
+        """
+        self.object = self.get_object()  # pylint: disable=W0201
+        terms = self.object[0] if len(self.object) == 1 else None
+        if terms is None:
+            return self.render_to_response(self.get_context_data(object=self.object))
+
+        etag = self.get_etag(terms)
+        response = None
+        if get_conditional_response is not None:
+            response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = self.render_to_response(self.get_context_data(object=self.object))
+        response['ETag'] = etag
+
+        if self.kwargs.get('version'):
+            max_age = getattr(settings, 'TERMS_VERSION_VIEW_CACHE_SECONDS', DEFAULT_TERMS_VERSION_VIEW_CACHE_SECONDS)
+        else:
+            max_age = TermsAndConditions.get_cache_timeout(
+                getattr(settings, 'TERMS_ACTIVE_VIEW_CACHE_SECONDS', DEFAULT_TERMS_ACTIVE_VIEW_CACHE_SECONDS))
+        if getattr(settings, 'TERMS_VIEW_CACHE_PUBLIC', False):
+            patch_cache_control(response, public=True, max_age=max_age)
+        else:
+            patch_cache_control(response, private=True, max_age=max_age)
+        return response
+
+    def get_etag(self, terms):
+        """
+        Returns a strong ETag of what is rendered for terms.
+
+        There is no Last-Modified, terms do not record when they were last edited, only when they were created.
+        """
+        content = b'\n'.join(force_bytes(value) for value in (
+            terms.pk, terms.slug, terms.version_number, terms.name, terms.text, terms.info, terms.date_active,
+            self.template_name, translation.get_language(),
+        ))
+        return '"{0}"'.format(hashlib.sha1(content).hexdigest())
+
 
 class AcceptTermsView(CreateView, GetTermsViewMixin):
     """
@@ -118,18 +184,22 @@ class AcceptTermsView(CreateView, GetTermsViewMixin):
         else:
             ip_address = ""
 
+        valid_terms_ids = []
         for terms_id in terms_ids:
             try:
-                new_user_terms = UserTermsAndConditions(
-                    user=user,
-                    terms=TermsAndConditions.objects.get(pk=int(terms_id)),
-                    ip_address=ip_address
-                )
-                new_user_terms.save()
-            except IntegrityError:  # pragma: nocover
-                pass
+                valid_terms_ids.append(int(terms_id))
+            except ValueError:
+                LOGGER.debug("Ignoring Invalid Terms ID: %s", terms_id)
+
+        UserTermsAndConditions.accept_terms(user, valid_terms_ids, ip_address)
+        forget_not_agreed_terms(request)
 
-        return HttpResponseRedirect(return_url)
+        if user_authenticated and get_acceptance_token_mode():
+            active_terms_ids = TermsAndConditions.get_active_terms_ids()
+            if not TermsAndConditions.get_active_terms_ids_not_agreed_to(user):
+                set_acceptance_token(request, user, active_terms_ids)
+
+        return save_acceptance_token(request, HttpResponseRedirect(return_url))
 
 
 class EmailTermsView(FormView, GetTermsViewMixin):
@@ -168,15 +238,24 @@ class EmailTermsView(FormView, GetTermsViewMixin):
         LOGGER.debug("Email Terms Body:")
         LOGGER.debug(template_rendered)
 
-        try:
-            send_mail(form.cleaned_data.get('email_subject', _('Terms')),
-                      template_rendered,
-                      settings.DEFAULT_FROM_EMAIL,
-                      [form.cleaned_data.get('email_address')],
-                      fail_silently=False)
+        if get_delivery_mode() in ('thread', 'outbox'):
+            # Delivered in the background, with the outcome recorded on the queued TermsEmail
+            queue_email(form.cleaned_data.get('email_subject', _('Terms')),
+                        template_rendered,
+                        settings.DEFAULT_FROM_EMAIL,
+                        form.cleaned_data.get('email_address'),
+                        terms=form.cleaned_data.get('terms'))
             messages.add_message(self.request, messages.INFO, _("Terms and Conditions Sent."))
-        except SMTPException:  # pragma: no cover
-            messages.add_message(self.request, messages.ERROR, _("An Error Occurred Sending Your Message."))
+        else:
+            try:
+                send_mail(form.cleaned_data.get('email_subject', _('Terms')),
+                          template_rendered,
+                          settings.DEFAULT_FROM_EMAIL,
+                          [form.cleaned_data.get('email_address')],
+                          fail_silently=False)
+                messages.add_message(self.request, messages.INFO, _("Terms and Conditions Sent."))
+            except SMTPException:  # pragma: no cover
+                messages.add_message(self.request, messages.ERROR, _("An Error Occurred Sending Your Message."))
 
         self.success_url = form.cleaned_data.get('returnTo', '/') or '/'
 
@@ -187,3 +266,24 @@ class EmailTermsView(FormView, GetTermsViewMixin):
         LOGGER.debug("Invalid Email Form Submitted")
         messages.add_message(self.request, messages.ERROR, _("Invalid Email Address."))
         return super(EmailTermsView, self).form_invalid(form)
+
+
+class MetricsView(View):
+    """
+    Terms and Conditions Metrics View, in the Prometheus text format
+
+    Only served to staff users and INTERNAL_IPS, and only if the metrics collector can render itself.
+
+    url: /terms/metrics
+    """
+
+    def get(self, request, *args, **kwargs):
+        """Renders the collected metrics"""
+        collector = metrics.get_collector()
+        if collector is None or not hasattr(collector, 'render'):
+            raise Http404
+
+        if not request.user.is_staff and request.META.get('REMOTE_ADDR') not in getattr(settings, 'INTERNAL_IPS', ()):
+            raise PermissionDenied
+
+        return HttpResponse(collector.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,232 @@
+"""
+Benchmarks the per-request terms checks against synthetic data, using SQLite and the locmem cache.
+
+Run from the project root with:
+
+    python termsandconditions_demo/run_benchmarks.py --users 1000 --slugs 3 --versions 10 --output bench.json
+
+Results are written as JSON, so runs on different commits can be compared.
+"""
+from __future__ import division, print_function
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import timeit
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'termsandconditions_demo.settings')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+
+CACHE_METHODS = ('get', 'get_many', 'set', 'set_many', 'add', 'delete', 'delete_many', 'incr')
+
+
+def generate_data(users=1000, slugs=3, versions=5, accepted=0.9):
+    """
+    Creates users, slugs with several active versions each, and acceptances of the latest versions.
+
+    The first `accepted` share of users has agreed to the latest version of every slug, the rest to none.
+    Returns the lists of users who have and have not accepted.
+    """
+    from django.contrib.auth.models import User
+    from termsandconditions.models import TermsAndConditions, UserTermsAndConditions
+
+    User.objects.bulk_create([
+        User(username='bench{0}'.format(number), email='bench{0}@example.com'.format(number))
+        for number in range(users)
+    ])
+    all_users = list(User.objects.filter(username__startswith='bench').order_by('pk'))
+
+    start = datetime.datetime(2012, 1, 1)
+    TermsAndConditions.objects.bulk_create([
+        TermsAndConditions(slug='bench-terms-{0}'.format(slug), name='Bench Terms {0}'.format(slug),
+                           text='Terms text ' * 500, version_number=version + 1,
+                           date_active=start + datetime.timedelta(days=version))
+        for slug in range(slugs) for version in range(versions)
+    ])
+    latest_ids = TermsAndConditions.get_active_terms_ids()
+
+    accepted_users = all_users[:int(round(len(all_users) * accepted))]
+    UserTermsAndConditions.objects.bulk_create([
+        UserTermsAndConditions(user=user, terms_id=terms_id, ip_address='127.0.0.1')
+        for user in accepted_users for terms_id in latest_ids
+    ])
+
+    return accepted_users, all_users[len(accepted_users):]
+
+
+class CacheCallCounter(object):
+    """Counts calls to the default cache backend while active, leaving out those a backend makes to itself"""
+
+    def __init__(self):
+        from django.core.cache import caches
+        self.backend = caches['default']
+        self.calls = 0
+        self.depth = 0
+
+    def __enter__(self):
+        for name in CACHE_METHODS:
+            setattr(self.backend, name, self._counting(getattr(self.backend, name)))
+        return self
+
+    def __exit__(self, *args):
+        for name in CACHE_METHODS:
+            delattr(self.backend, name)
+
+    def _counting(self, method):
+        """Wraps a backend method so every call is counted"""
+        def counted(*args, **kwargs):
+            # Backends without native batch operations implement get_many with get, count it once
+            if not self.depth:
+                self.calls += 1
+            self.depth += 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.depth -= 1
+        return counted
+
+
+def measure(name, scenario, call, arguments, before=None):
+    """Runs call once per argument and returns latency, query and cache call statistics"""
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    timings = []
+    queries = 0
+    cache_calls = 0
+    for argument in arguments:
+        if before is not None:
+            before()
+        with CaptureQueriesContext(connection) as captured, CacheCallCounter() as counter:
+            started = timeit.default_timer()
+            call(argument)
+            timings.append((timeit.default_timer() - started) * 1000)
+        queries += len(captured)
+        cache_calls += counter.calls
+
+    timings.sort()
+    count = len(timings)
+    return {
+        'name': name,
+        'scenario': scenario,
+        'iterations': count,
+        'mean_ms': sum(timings) / count,
+        'p50_ms': timings[int(count * 0.50)],
+        'p95_ms': timings[min(count - 1, int(count * 0.95))],
+        'queries_per_call': queries / count,
+        'cache_calls_per_call': cache_calls / count,
+    }
+
+
+def run_benchmarks(accepted_users, pending_users, iterations=200):
+    """Measures the middleware, decorator, template tag and accept view, returns a list of results"""
+    from django.contrib.auth.models import AnonymousUser
+    from django.core.cache import cache
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+    from termsandconditions.decorators import terms_required
+    from termsandconditions.middleware import TermsAndConditionsRedirectMiddleware
+    from termsandconditions.models import TermsAndConditions
+    from termsandconditions.templatetags.terms_tags import show_terms_if_not_agreed
+    from termsandconditions.views import AcceptTermsView
+
+    factory = RequestFactory()
+    middleware = TermsAndConditionsRedirectMiddleware(lambda request: HttpResponse())
+    protected_view = terms_required(lambda request: HttpResponse())
+    accept_view = AcceptTermsView.as_view()
+
+    def get_request(user):
+        """Returns a GET request for a protected page, made by user"""
+        request = factory.get('/secure/')
+        request.user = user
+        request.session = {}
+        return request
+
+    def post_accept(user):
+        """Accepts all active terms for user through the accept view"""
+        request = factory.post('/terms/accept/', {'terms': TermsAndConditions.get_active_terms_ids(),
+                                                  'returnTo': '/secure/'})
+        request.user = user
+        request.session = {}
+        accept_view(request)
+
+    checks = (
+        ('middleware', lambda user: middleware.process_request(get_request(user))),
+        ('terms_required', lambda user: protected_view(get_request(user))),
+        ('show_terms_if_not_agreed', lambda user: show_terms_if_not_agreed({'request': get_request(user)})),
+    )
+
+    def sample(users):
+        """Returns iterations users, cycling through the given ones"""
+        return [users[number % len(users)] for number in range(iterations)] if users else []
+
+    results = []
+    for users_name, users in (('accepted', accepted_users), ('pending', pending_users)):
+        users = sample(users)
+        if not users:
+            continue
+        for name, call in checks:
+            results.append(measure(name, users_name + '-cold', call, users, before=cache.clear))
+            for user in users:
+                call(user)  # Warm the cache for every sampled user
+            results.append(measure(name, users_name + '-warm', call, users))
+
+    results.append(measure('show_terms_if_not_agreed', 'anonymous', checks[2][1], [AnonymousUser()] * iterations))
+    if pending_users:
+        results.append(measure('AcceptTermsView.post', 'pending', post_accept, pending_users[:iterations]))
+
+    return results
+
+
+def main(argv=None):
+    """Sets up a throwaway database, generates data, runs the benchmarks and writes the JSON report"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000, help='number of users to create')
+    parser.add_argument('--slugs', type=int, default=3, help='number of terms slugs')
+    parser.add_argument('--versions', type=int, default=5, help='number of active versions per slug')
+    parser.add_argument('--accepted', type=float, default=0.9, help='share of users who accepted the latest terms')
+    parser.add_argument('--iterations', type=int, default=200, help='calls measured per benchmark')
+    parser.add_argument('--output', help='file to write the JSON report to, defaults to stdout')
+    options = parser.parse_args(argv)
+
+    django.setup()
+    logging.disable(logging.CRITICAL)
+
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    settings.CACHES['default'] = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        accepted_users, pending_users = generate_data(
+            options.users, options.slugs, options.versions, options.accepted)
+        results = run_benchmarks(accepted_users, pending_users, options.iterations)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    report = json.dumps({
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'parameters': vars(options),
+        'results': results,
+    }, indent=2, sort_keys=True)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()